@@ -0,0 +1,106 @@
+# Copyright 2018 kWh Analytics
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# pyou may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import cPickle
+import gc
+import os
+import time
+
+
+SNAPSHOT_VERSION = 1
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    # Pickling millions of small objects otherwise triggers the cyclic
+    # garbage collector over and over.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def save_checkpoint(instance, filename):
+    """
+    Writes a snapshot of the instance -- its ingested data, hypercube
+    context tables and progress markers -- to filename. The snapshot is
+    written to a temporary file first and renamed into place, so a worker
+    killed mid-write leaves the previous checkpoint intact. Instances with
+    a SQLiteContextStore only save its filename; that file must be kept.
+    """
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as outfile:
+        with _gc_paused():
+            cPickle.dump({"version": SNAPSHOT_VERSION, "instance": instance},
+                         outfile, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_filename, filename)
+
+
+def resume(filename):
+    """
+    Loads the instance saved by save_checkpoint(). Continue ingesting into
+    it; CursorIngest sources with a name skip the rows they had already
+    read (see instance.progress).
+    """
+    with open(filename, "rb") as infile:
+        with _gc_paused():
+            snapshot = cPickle.load(infile)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise Exception("Unsupported checkpoint version {}".format(
+            snapshot.get("version")))
+    return snapshot["instance"]
+
+
+class Checkpointer(object):
+    """
+    Saves checkpoints of an instance at a configurable interval, in rows
+    ingested and/or seconds elapsed. Call tick() whenever the instance is
+    in a consistent state, e.g. after each batch (CursorIngest does this
+    if given a checkpointer). Not meant to be called while other threads
+    are adding to the instance.
+    """
+    def __init__(self, instance, filename, every_rows=None,
+                 every_seconds=None):
+        self.instance = instance
+        self.filename = filename
+        self.every_rows = every_rows
+        self.every_seconds = every_seconds
+        self.rows_since = 0
+        self.last_saved = time.time()
+        self.saves = 0
+
+    def tick(self, rows=1):
+        """
+        Records that rows more rows were ingested; saves a checkpoint if
+        an interval has passed. Returns True if it saved.
+        """
+        self.rows_since += rows
+        if self.every_rows is not None and self.rows_since >= self.every_rows:
+            self.save()
+            return True
+        if self.every_seconds is not None and \
+                time.time() - self.last_saved >= self.every_seconds:
+            self.save()
+            return True
+        return False
+
+    def save(self):
+        save_checkpoint(self.instance, self.filename)
+        self.rows_since = 0
+        self.last_saved = time.time()
+        self.saves += 1
@@ -0,0 +1,295 @@
+# Copyright 2018 kWh Analytics
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# pyou may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import cPickle
+import hashlib
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+
+from xbrl_generator import Context, Fact
+
+
+def _dumps(value):
+    return sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+
+def _loads(blob):
+    return cPickle.loads(str(blob))
+
+
+def _canonical(value):
+    # Equal str and unicode values must hash alike.
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, tuple):
+        return tuple(_canonical(item) for item in value)
+    return value
+
+
+def _key_hash(key):
+    # hash() differs between processes (python -R, PYTHONHASHSEED), and a
+    # store can be reopened by a resumed run, so use 64 bits of an MD5 of
+    # the key's repr instead.
+    digest = hashlib.md5(repr(_canonical(key))).digest()
+    return struct.unpack("<q", digest[:8])[0]
+
+
+class SQLiteContextStore(object):
+    """
+    Disk-backed storage for hypercube contexts and facts, for documents
+    whose context set doesn't fit in memory. Keeps a bounded LRU cache of
+    recently used contexts; everything else lives in a SQLite file. Pass an
+    instance as context_store when creating an AbstractXBRLInstance.
+    """
+    def __init__(self, filename=None, cache_size=10000, batch_size=5000,
+                 durable=False):
+        """
+        filename is the SQLite file to use; if None, a temporary file is
+        created and deleted again by close().
+        cache_size is the maximum number of Context objects kept in memory.
+        batch_size is how many pending writes are buffered before they are
+        sent to SQLite.
+        durable selects a journal that survives the process being killed
+        mid-write; the store switches to it by itself when it is first
+        checkpointed (see checkpoint.py).
+        """
+        self._owns_file = filename is None
+        if filename is None:
+            fd, filename = tempfile.mkstemp(suffix=".sqlite")
+            os.close(fd)
+        self.filename = filename
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+
+        # Contexts by (table name, context key) and by row number:
+        self._by_key = collections.OrderedDict()
+        self._by_row = collections.OrderedDict()
+        self._pending_facts = []
+        self._writes = 0
+
+        # Hypercubes call in from several producer threads (each holding
+        # its own lock), so the connection is shared and guarded by ours:
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.text_factory = str
+        self.durable = False
+        if durable:
+            self.make_durable()
+        else:
+            # Until a checkpoint depends on the file, it is scratch space
+            # for one document build, so trade durability for speed:
+            self._conn.execute("PRAGMA synchronous = OFF")
+            self._conn.execute("PRAGMA journal_mode = MEMORY")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS contexts ("
+            " row INTEGER PRIMARY KEY, tablename TEXT, keyhash INTEGER,"
+            " key BLOB, context_id TEXT)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS contexts_by_key"
+            " ON contexts (tablename, keyhash)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS facts ("
+            " seq INTEGER PRIMARY KEY, concept TEXT, context_row INTEGER,"
+            " units TEXT, value BLOB, decimals INTEGER)")
+
+    def make_durable(self):
+        """
+        Switches to a write-ahead log, so that the file stays consistent
+        if the process dies in the middle of a transaction.
+        """
+        with self._lock:
+            self._conn.commit()
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self.durable = True
+
+    def __getstate__(self):
+        # Pickling (see checkpoint.py) saves only where the data is; the
+        # file itself must be kept, and is not deleted by the reopened store.
+        # The last context row is saved too: contexts added after the
+        # checkpoint must be dropped on resume, since the hypercubes'
+        # counters (and so the next context IDs) are those of the snapshot.
+        with self._lock:
+            self.flush()
+            if not self.durable:
+                self.make_durable()
+            last_row = self._conn.execute(
+                "SELECT MAX(row) FROM contexts").fetchone()[0]
+        return {"filename": self.filename, "cache_size": self.cache_size,
+                "batch_size": self.batch_size, "last_row": last_row or 0}
+
+    def __setstate__(self, state):
+        self.__init__(state["filename"], state["cache_size"],
+                      state["batch_size"], durable=True)
+        self._owns_file = False
+        self._conn.execute("DELETE FROM contexts WHERE row > ?",
+                           (state["last_row"],))
+        self._conn.execute("DELETE FROM facts")
+        self._conn.commit()
+
+    def _cache_get(self, cache, cache_key):
+        context = cache.pop(cache_key, None)
+        if context is not None:
+            cache[cache_key] = context
+        return context
+
+    def _cache_put(self, cache, cache_key, context):
+        cache[cache_key] = context
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def _remember(self, cube, key, context):
+        self._cache_put(self._by_key, (cube.tableName, key), context)
+        self._cache_put(self._by_row, context._store_row, context)
+
+    def _rebuild(self, cube, key, context_id, row):
+        # Re-create a Context object that was evicted from the cache.
+        period, dimensions = key
+        duration = instant = None
+        if period[0] == "duration":
+            duration = (period[1], period[2])
+        elif period[0] == "instant":
+            instant = period[1]
+        context = Context(cube, cube.entity, duration, instant,
+                          dict(dimensions))
+        context.set_id(context_id)
+        context._store_row = row
+        return context
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes >= self.batch_size:
+            self.flush()
+
+    def get_context(self, cube, key):
+        """
+        Returns the Context in the given hypercube with the given
+        context_key(), or None if there isn't one yet.
+        """
+        with self._lock:
+            context = self._cache_get(self._by_key, (cube.tableName, key))
+            if context is not None:
+                return context
+            rows = self._conn.execute(
+                "SELECT row, key, context_id FROM contexts"
+                " WHERE tablename = ? AND keyhash = ?",
+                (cube.tableName, _key_hash(key))).fetchall()
+            for row, blob, context_id in rows:
+                if _loads(blob) == key:
+                    context = self._rebuild(cube, key, context_id, row)
+                    self._remember(cube, key, context)
+                    return context
+            return None
+
+    def add_context(self, cube, key, context):
+        """
+        Stores a newly created Context of the given hypercube.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO contexts (tablename, keyhash, key, context_id)"
+                " VALUES (?, ?, ?, ?)",
+                (cube.tableName, _key_hash(key), _dumps(key),
+                 context.get_id()))
+            context._store_row = cursor.lastrowid
+            self._remember(cube, key, context)
+            self._wrote()
+
+    def count_contexts(self, tableName):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM contexts WHERE tablename = ?",
+                (tableName,)).fetchone()[0]
+
+    def iter_contexts(self, cube):
+        """
+        Yields the contexts of the given hypercube in ID order. Don't
+        add contexts while iterating.
+        """
+        self.flush()
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT row, key, context_id FROM contexts"
+                       " WHERE tablename = ? ORDER BY row", (cube.tableName,))
+        for row, blob, context_id in cursor:
+            context = self._cache_get(self._by_row, row)
+            if context is None:
+                context = self._rebuild(cube, _loads(blob),
+                                        context_id, row)
+            yield context
+
+    def add_fact(self, fact):
+        """
+        Appends a Fact whose context came from this store.
+        """
+        with self._lock:
+            self._pending_facts.append(
+                (fact.concept, fact.context._store_row, fact.units,
+                 _dumps(fact.value), fact.decimals))
+            self._wrote()
+
+    def count_facts(self):
+        with self._lock:
+            self.flush()
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM facts").fetchone()[0]
+
+    def iter_facts(self, hypercubes):
+        """
+        Yields the stored facts in the order they were added. hypercubes
+        maps table names to the Hypercube objects the contexts belong to.
+        """
+        self.flush()
+        cursor = self._conn.cursor()
+        cursor.execute(
+            "SELECT f.concept, f.units, f.value, f.decimals,"
+            " c.row, c.tablename, c.key, c.context_id"
+            " FROM facts f JOIN contexts c ON f.context_row = c.row"
+            " ORDER BY f.seq")
+        for concept, units, value, decimals, row, tableName, blob, \
+                context_id in cursor:
+            context = self._cache_get(self._by_row, row)
+            if context is None:
+                cube = hypercubes[tableName]
+                key = _loads(blob)
+                context = self._rebuild(cube, key, context_id, row)
+                self._remember(cube, key, context)
+            yield Fact(concept, context, units, _loads(value),
+                       decimals)
+
+    def clear_facts(self):
+        with self._lock:
+            self._pending_facts = []
+            self._conn.execute("DELETE FROM facts")
+
+    def flush(self):
+        """
+        Writes any buffered facts and commits.
+        """
+        with self._lock:
+            if self._pending_facts:
+                self._conn.executemany(
+                    "INSERT INTO facts (concept, context_row, units, value,"
+                    " decimals) VALUES (?, ?, ?, ?, ?)", self._pending_facts)
+                self._pending_facts = []
+            self._conn.commit()
+            self._writes = 0
+
+    def close(self):
+        self._conn.close()
+        if self._owns_file:
+            os.remove(self.filename)
@@ -0,0 +1,195 @@
+# Copyright 2018 kWh Analytics
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# pyou may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import Queue
+
+
+class _FetchFailure(object):
+    # Carries an exception from the fetching thread to the consumer.
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class CursorIngest(object):
+    """
+    Feeds the rows of a DB-API cursor into an AbstractXBRLInstance
+    subclass, one fetchmany() batch at a time, by calling one of the
+    instance's add methods (e.g. MonthlyOperatingReport.addData or
+    SystemInstallationSheet.addSystem) once per row.
+    """
+    def __init__(self, cursor, method, column_map, fact_columns=None,
+                 facts_argument="facts", converters=None, batch_size=1000,
+                 background=True, queue_depth=4, name=None,
+                 checkpointer=None):
+        """
+        cursor is a DB-API cursor on which a query has been executed.
+        method is the name of the instance method to call for each row,
+        or a function that is called with the instance as first argument.
+        column_map maps column names to that method's keyword arguments,
+        e.g. {"system": "system_name", "month": "prod_month"}.
+        fact_columns optionally maps column names to fact names; those
+        columns are collected into a dictionary passed as the
+        facts_argument keyword (the signature of addSystem, addArray etc.).
+        NULL values are left out of the facts dictionary.
+        converters optionally maps column names to functions applied to
+        the raw column value.
+        batch_size is the fetchmany() size.
+        If background is True, batches are fetched on a separate thread
+        while the instance processes the previous ones; at most
+        queue_depth batches are buffered. Note that sqlite3 connections
+        must then be opened with check_same_thread=False.
+        name identifies this source in instance.progress, which records
+        how many rows have been ingested. When ingesting into an instance
+        resumed from a checkpoint, that many rows of the (re-executed)
+        query are skipped.
+        checkpointer is an optional checkpoint.Checkpointer, ticked after
+        every batch.
+        """
+        self.cursor = cursor
+        self.method = method
+        self.column_map = column_map
+        self.fact_columns = fact_columns or {}
+        self.facts_argument = facts_argument
+        self.converters = converters or {}
+        self.batch_size = batch_size
+        self.background = background
+        self.queue_depth = queue_depth
+        self.name = name
+        self.checkpointer = checkpointer
+        self.rows_ingested = 0
+
+    def _compile_row_mapper(self):
+        # Work out once which tuple positions feed which argument, so that
+        # each row is only a handful of index operations.
+        columns = [description[0] for description in self.cursor.description]
+        for name in list(self.column_map) + list(self.fact_columns):
+            if name not in columns:
+                raise Exception("Cursor has no column named {}".format(name))
+        arguments = [(columns.index(name), argument,
+                      self.converters.get(name))
+                     for name, argument in self.column_map.items()]
+        facts = [(columns.index(name), fact_name, self.converters.get(name))
+                 for name, fact_name in self.fact_columns.items()]
+        facts_argument = self.facts_argument
+
+        def map_row(row):
+            kwargs = {}
+            for index, argument, convert in arguments:
+                value = row[index]
+                kwargs[argument] = convert(value) if convert else value
+            if facts:
+                fact_values = {}
+                for index, fact_name, convert in facts:
+                    value = row[index]
+                    if value is None:
+                        continue
+                    fact_values[fact_name] = convert(value) if convert \
+                        else value
+                kwargs[facts_argument] = fact_values
+            return kwargs
+        return map_row
+
+    def _skip(self, rows):
+        # Discard rows already ingested before the last checkpoint.
+        while rows > 0:
+            skipped = len(self.cursor.fetchmany(min(rows, self.batch_size)))
+            if skipped == 0:
+                return
+            rows -= skipped
+
+    def _batches(self):
+        while True:
+            batch = self.cursor.fetchmany(self.batch_size)
+            if not batch:
+                return
+            yield batch
+
+    def _background_batches(self):
+        # Producer thread fetches ahead into a bounded queue; errors are
+        # handed over to the consuming thread and re-raised there.
+        batches = Queue.Queue(maxsize=self.queue_depth)
+        done = object()
+        stop = threading.Event()
+
+        def offer(item):
+            # Blocks while the queue is full, unless the consumer gave up.
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for batch in self._batches():
+                    if not offer(batch):
+                        return
+                offer(done)
+            except Exception:
+                offer(_FetchFailure(sys.exc_info()))
+
+        fetcher = threading.Thread(target=fetch)
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    break
+                if isinstance(batch, _FetchFailure):
+                    raise batch.exc_info[0], batch.exc_info[1], \
+                        batch.exc_info[2]
+                yield batch
+        finally:
+            stop.set()
+            fetcher.join()
+
+    def ingest(self, instance):
+        """
+        Reads every remaining row from the cursor into the given instance.
+        Returns the number of rows ingested.
+        """
+        if callable(self.method):
+            add = lambda **kwargs: self.method(instance, **kwargs)
+        else:
+            add = getattr(instance, self.method)
+        map_row = self._compile_row_mapper()
+        done = 0
+        if self.name is not None:
+            done = instance.progress.get(self.name, 0)
+            self._skip(done)
+        if self.background:
+            batches = self._background_batches()
+        else:
+            batches = self._batches()
+        count = 0
+        try:
+            for batch in batches:
+                for row in batch:
+                    add(**map_row(row))
+                count += len(batch)
+                self.rows_ingested += len(batch)
+                if self.name is not None:
+                    instance.progress[self.name] = done + count
+                if self.checkpointer is not None:
+                    self.checkpointer.tick(len(batch))
+        finally:
+            # If add() raised, stop and join the fetching thread now rather
+            # than whenever the generator is garbage-collected.
+            batches.close()
+        return count
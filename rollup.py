@@ -0,0 +1,302 @@
+# Copyright 2018 kWh Analytics
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# pyou may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    # numpy is optional; without it roll-ups are computed in plain Python.
+    numpy = None
+
+
+AGGREGATES = ["sum", "mean", "min", "max"]
+
+
+def _period_key(duration, instant):
+    # The period part of xbrl_generator.context_key().
+    if duration is not None and duration != "forever":
+        return ("duration", duration[0], duration[1])
+    if instant is not None:
+        return ("instant", instant)
+    return ("forever",)
+
+
+class RollUp(object):
+    """
+    An aggregate over the facts of one concept, e.g. the total
+    MeasuredEnergy of all systems per month. Facts are grouped by table,
+    period and dimensions after dropping drop_dimensions (or after mapping
+    them through regroup), and one fact per group is added to the document.
+    Add with AbstractXBRLInstance.addRollUp().
+    """
+    def __init__(self, concept, tableName=None, aggregate="sum",
+                 drop_dimensions=["PVSystemIdentifierAxis"], regroup=None,
+                 target_table=None, target_concept=None):
+        """
+        tableName limits the roll-up to facts in one table; if None, facts
+        of the concept in any table are included.
+        aggregate is one of AGGREGATES.
+        regroup, if given, is called with each fact's extra dimensions and
+        returns the dimensions of its roll-up context, or None to leave the
+        fact out; drop_dimensions is then ignored. Use a module-level
+        function or class (not a lambda) if the instance is checkpointed.
+        target_table and target_concept default to the facts' own.
+        """
+        if aggregate not in AGGREGATES:
+            raise Exception("Unknown aggregate {}".format(aggregate))
+        self.concept = concept
+        self.tableName = tableName
+        self.aggregate = aggregate
+        self.drop_dimensions = drop_dimensions
+        self.regroup = regroup
+        self.target_table = target_table
+        self.target_concept = target_concept or concept
+
+    def _identity(self):
+        return (self.concept, self.tableName, self.aggregate,
+                tuple(self.drop_dimensions), self.regroup, self.target_table,
+                self.target_concept)
+
+    def __eq__(self, other):
+        return isinstance(other, RollUp) and \
+            self._identity() == other._identity()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def target_dimensions(self, extra_dimensions):
+        """
+        Returns the roll-up context's dimensions, as a sorted tuple of
+        items, for a fact with the given extra dimensions; None if the fact
+        isn't included.
+        """
+        if self.regroup is not None:
+            dimensions = self.regroup(extra_dimensions)
+            if dimensions is None:
+                return None
+            return tuple(sorted(dimensions.items()))
+        return tuple(sorted((dimension, member) for dimension, member
+                            in extra_dimensions.items()
+                            if dimension not in self.drop_dimensions))
+
+
+class RollUpAccumulator(object):
+    """
+    Collects the values of the facts that roll-ups apply to as columns --
+    a group number and a value per fact -- and computes every aggregate
+    at the end with vectorized group-by operations. Time series blocks
+    are added as whole arrays.
+    """
+    def __init__(self, rollups):
+        self.rollups = rollups
+        self._by_concept = {}
+        for index, rollup in enumerate(rollups):
+            self._by_concept.setdefault(rollup.concept, []).append(index)
+        # Group number by (roll-up, table, period, dimensions, units), and
+        # for each group that key plus the largest decimals seen:
+        self._group_ids = {}
+        self._groups = []
+        # Group number (-1 for none) by roll-up and source context:
+        self._context_groups = {}
+        self._block_groups = {}
+        # The facts' columns; time series add whole (groups, values) chunks.
+        self._fact_group_column = array.array("l")
+        self._fact_value_column = array.array("d")
+        self._chunks = []
+
+    def _group_id(self, index, tableName, period, dimensions, units,
+                  decimals):
+        key = (index, tableName, period, dimensions, units)
+        group = self._group_ids.get(key)
+        if group is None:
+            group = len(self._groups)
+            self._group_ids[key] = group
+            self._groups.append([key, decimals])
+        elif decimals > self._groups[group][1]:
+            self._groups[group][1] = decimals
+        return group
+
+    def _check_source(self, rollup, tableName, extra_dimensions,
+                      dimensions):
+        # A source fact already in its own roll-up context would end up
+        # next to the aggregate as a second fact of the same concept.
+        if (rollup.target_table or tableName) == tableName and \
+                rollup.target_concept == rollup.concept and \
+                dimensions == tuple(sorted(extra_dimensions.items())):
+            raise Exception(
+                "A fact of {} in {} is already in its roll-up context {}"
+                .format(rollup.concept, tableName, dict(dimensions)))
+
+    def _context_group(self, index, context, units, decimals):
+        rollup = self.rollups[index]
+        tableName = context.hypercube.tableName
+        if rollup.tableName is not None and rollup.tableName != tableName:
+            return -1
+        dimensions = rollup.target_dimensions(context.extra_dimensions)
+        if dimensions is None:
+            return -1
+        self._check_source(rollup, tableName, context.extra_dimensions,
+                           dimensions)
+        return self._group_id(index, rollup.target_table or tableName,
+                              _period_key(context.duration, context.instant),
+                              dimensions, units, decimals)
+
+    def add_fact(self, fact):
+        indexes = self._by_concept.get(fact.concept)
+        if indexes is None:
+            return
+        value = fact.value
+        if value is None:
+            return
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise Exception("Can't roll up non-numeric value {} of {}".format(
+                value, fact.concept))
+        context = fact.context
+        for index in indexes:
+            cache_key = (index, context.hypercube.tableName, context.get_id(),
+                         fact.units, fact.decimals)
+            group = self._context_groups.get(cache_key)
+            if group is None:
+                group = self._context_group(index, context, fact.units,
+                                            fact.decimals)
+                self._context_groups[cache_key] = group
+            if group >= 0:
+                self._fact_group_column.append(group)
+                self._fact_value_column.append(value)
+
+    def add_block(self, block):
+        """
+        Adds the values of a TimeSeriesBlock. Blocks whose roll-up periods
+        and dimensions are the same share one array of group numbers.
+        """
+        for index in self._by_concept.get(block.concept, []):
+            rollup = self.rollups[index]
+            if rollup.tableName is not None and \
+                    rollup.tableName != block.tableName:
+                continue
+            dimensions = rollup.target_dimensions(block.extra_dimensions)
+            if dimensions is None:
+                continue
+            self._check_source(rollup, block.tableName,
+                               block.extra_dimensions, dimensions)
+            tableName = rollup.target_table or block.tableName
+            shape = (index, tableName, block.start, block.frequency,
+                     len(block), dimensions, block.units, block.decimals)
+            groups = self._block_groups.get(shape)
+            if groups is None:
+                groups = [self._group_id(index, tableName,
+                                         ("duration", start, end),
+                                         dimensions, block.units,
+                                         block.decimals)
+                          for start, end in block.periods()]
+                if numpy is not None:
+                    groups = numpy.array(groups, dtype=numpy.int_)
+                self._block_groups[shape] = groups
+            self._chunks.append((groups, block.values))
+
+    def _columns(self):
+        # All (groups, values) as two flat arrays, without missing values.
+        groups = [numpy.frombuffer(self._fact_group_column, dtype=numpy.int_)]
+        values = [numpy.frombuffer(self._fact_value_column,
+                                   dtype=numpy.float64)]
+        for chunk_groups, chunk_values in self._chunks:
+            groups.append(chunk_groups)
+            values.append(numpy.asarray(chunk_values, dtype=numpy.float64))
+        groups = numpy.concatenate(groups)
+        values = numpy.concatenate(values)
+        present = ~numpy.isnan(values)
+        return groups[present], values[present]
+
+    def _aggregate(self):
+        # Returns (count, result) arrays indexed by group number; each
+        # group gets the aggregate of its own roll-up.
+        groups, values = self._columns()
+        size = len(self._groups)
+        count = numpy.bincount(groups, minlength=size)
+        aggregates = numpy.array([AGGREGATES.index(
+            self.rollups[key[0]].aggregate) for key, decimals in self._groups],
+            dtype=numpy.int_)
+        result = numpy.zeros(size)
+        needed = set(self.rollups[key[0]].aggregate
+                     for key, decimals in self._groups)
+        if "sum" in needed or "mean" in needed:
+            total = numpy.bincount(groups, weights=values, minlength=size)
+            result = numpy.where(aggregates == AGGREGATES.index("sum"),
+                                 total, result)
+            mean = total / numpy.maximum(count, 1)
+            result = numpy.where(aggregates == AGGREGATES.index("mean"),
+                                 mean, result)
+        if ("min" in needed or "max" in needed) and len(groups):
+            # Sort by group and reduce each run of equal group numbers:
+            order = numpy.argsort(groups, kind="mergesort")
+            sorted_groups = groups[order]
+            sorted_values = values[order]
+            starts = numpy.flatnonzero(numpy.concatenate(
+                ([True], sorted_groups[1:] != sorted_groups[:-1])))
+            present = sorted_groups[starts]
+            for name, ufunc in [("min", numpy.minimum),
+                                ("max", numpy.maximum)]:
+                if name in needed:
+                    reduced = numpy.zeros(size)
+                    reduced[present] = ufunc.reduceat(sorted_values, starts)
+                    result = numpy.where(
+                        aggregates == AGGREGATES.index(name), reduced, result)
+        return count.tolist(), result.tolist()
+
+    def _aggregate_without_numpy(self):
+        size = len(self._groups)
+        count = [0] * size
+        result = [None] * size
+        columns = [(self._fact_group_column, self._fact_value_column)]
+        columns.extend(self._chunks)
+        for groups, values in columns:
+            for group, value in zip(groups, values):
+                if value is None or value != value: # NaN: no data
+                    continue
+                value = float(value)
+                aggregate = self.rollups[self._groups[group][0][0]].aggregate
+                if count[group] == 0:
+                    result[group] = value
+                elif aggregate in ("sum", "mean"):
+                    result[group] += value
+                elif aggregate == "min":
+                    result[group] = min(result[group], value)
+                else:
+                    result[group] = max(result[group], value)
+                count[group] += 1
+        for group in range(size):
+            if count[group] and \
+                    self.rollups[self._groups[group][0][0]].aggregate == "mean":
+                result[group] /= count[group]
+        return count, result
+
+    def results(self):
+        """
+        Yields (rollup, tableName, period, dimensions, units, decimals,
+        value) for each group with at least one value, in the order the
+        groups were first seen. period is as in context_key().
+        """
+        if numpy is not None:
+            count, result = self._aggregate()
+        else:
+            count, result = self._aggregate_without_numpy()
+        for group, (key, decimals) in enumerate(self._groups):
+            if count[group] == 0:
+                continue
+            index, tableName, period, dimensions, units = key
+            yield (self.rollups[index], tableName, period, dimensions, units,
+                   decimals, result[group])
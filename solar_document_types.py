@@ -18,6 +18,30 @@ import calendar
 
 # TODO validate that the unit names we pass in are actually valid
 
+
+def site_identifier(system_identifier):
+    # Each system currently gets its own site in the SiteIdentifierTable.
+    return "site for {}".format(system_identifier)
+
+
+class SiteOfSystem(object):
+    """
+    RollUp regroup function that moves a fact from its system to the
+    system's site. A class rather than a lambda so that it can be pickled.
+    """
+    def __call__(self, extra_dimensions):
+        system_identifier = extra_dimensions.get("PVSystemIdentifierAxis")
+        if system_identifier is None:
+            return None
+        return {"SiteIdentifierAxis": site_identifier(system_identifier)}
+
+    def __eq__(self, other):
+        return isinstance(other, SiteOfSystem)
+
+    def __ne__(self, other):
+        return not self == other
+
+
 class AbstractSolarXBRLInstance(AbstractXBRLInstance):
     """
     Subclass of AbstractXBRLInstance that specifies a few more solar-specific
@@ -25,12 +49,13 @@ class AbstractSolarXBRLInstance(AbstractXBRLInstance):
     solar document classes should inherit from this one.
     """
 
-    def __init__(self, entity_name = "Unspecified"):
+    def __init__(self, entity_name = "Unspecified", context_store=None):
         taxonomy = "https://raw.githubusercontent.com/xbrlus/solar/v1.2/core/solar_2018-03-31_r01.xsd"
         super( AbstractSolarXBRLInstance, self).__init__(
             taxonomy,
             extra_ns={"xmlns:solar": "http://xbrl.us/Solar/v1.2/2018-03-31/solar"},
-            entity_name=entity_name)
+            entity_name=entity_name,
+            context_store=context_store)
 
     def getTypedDimensionDomains(self):
         # This needs to get passed into every new Hypercube that is instantiated
@@ -42,6 +67,12 @@ class AbstractSolarXBRLInstance(AbstractXBRLInstance):
             "PeriodAxis": "PeriodDomain" # This is an enum type, does it belong here?
             }
 
+    def getConceptDatatypes(self):
+        return {
+            "SystemCommercialOperationsDate": "date",
+            "EquipmentTypeNumber": "integer"
+            }
+
     def getNamespacePrefix(self):
         return "solar"
 
@@ -52,8 +83,10 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
     system located at a site and comprising one or more arrays.
     """
 
-    def __init__(self, unit_map, concept_map, entity_name="A Company"):
-        super(SystemInstallationSheet, self).__init__(entity_name)
+    def __init__(self, unit_map, concept_map, entity_name="A Company",
+                 context_store=None):
+        super(SystemInstallationSheet, self).__init__(entity_name,
+                                                      context_store)
         self.systems = {} # keyed by system id
         self.arrays = {}
         self.inverters = {}
@@ -62,6 +95,10 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
         self.required_units = []
         self.unit_map = unit_map
         self.concept_map = concept_map
+        # Decimals for concepts that need more precision than the default
+        # of 2; six decimal places of a degree are about 0.1m:
+        self.concept_decimals = {"SiteLatitudeAtSystemEntrance": 6,
+                                 "SiteLongitudeAtSystemEntrance": 6}
 
     def lookUpUnit(self, concept):
         # TODO move this to base class, i think
@@ -72,6 +109,9 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
             self.required_units.append(unit)
         return unit
 
+    def lookUpDecimals(self, concept):
+        return self.concept_decimals.get(concept, 2)
+
     def convertNames(self, facts):
         renamed_facts = {}
         for key in facts:
@@ -88,14 +128,13 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
         self.systems[systemid] = self.convertNames(facts)
 
     def addArray(self, systemid, facts):
-        if not systemid in self.arrays:
-            self.arrays[systemid] = []
-        self.arrays[systemid].append(self.convertNames(facts))
+        # setdefault rather than check-then-insert, so that producers on
+        # several threads can't replace each other's lists:
+        self.arrays.setdefault(systemid, []).append(self.convertNames(facts))
 
     def addInverter(self, systemid, facts):
-        if not systemid in self.inverters:
-            self.inverters[systemid] = []
-        self.inverters[systemid].append(self.convertNames(facts))
+        self.inverters.setdefault(systemid, []).append(
+            self.convertNames(facts))
 
     def addSite(self, systemid, facts):
         for key in facts:
@@ -108,16 +147,27 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
 
         # Would it make more sense to turn things into facts as they're added?
 
-        if not systemid in self.seasonal_extras:
-            self.seasonal_extras[systemid] = {}
-        self.seasonal_extras[systemid][fieldName] = values
+        self.seasonal_extras.setdefault(systemid, {})[fieldName] = values
+
 
+    def addSiteTotals(self, concepts, aggregate="sum"):
+        """
+        Adds, for each of the given concepts (e.g. ModuleNameplateCapacity),
+        its total over each site's systems, arrays and products, reported
+        in the SiteIdentifierTable. See AbstractXBRLInstance.addRollUp.
+        """
+        for concept in concepts:
+            self.addRollUp(concept, aggregate=aggregate,
+                           regroup=SiteOfSystem(),
+                           target_table="SiteIdentifierTable")
 
     def get_required_units(self):
         return self.required_units
 
     def get_facts(self):
-        facts = []
+        return list(self.iter_facts())
+
+    def iter_facts(self):
         report_generation_date = datetime.date.today() # Used for Instant duration
 
         # there's both Azimuth and OrientationAzimuth??
@@ -157,10 +207,11 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
                             context = arrayContext
                         else:
                             context = productContext
-                        facts.append(Fact(fieldName,
-                                        context,
-                                        self.lookUpUnit(fieldName),
-                                        array_data[fieldName]))
+                        yield Fact(fieldName,
+                                   context,
+                                   self.lookUpUnit(fieldName),
+                                   array_data[fieldName],
+                                   self.lookUpDecimals(fieldName))
                         # could also add a fact that "TypeOfDevice" = "ModuleMember"
             else:
                 print "Warning: No array data for {}".format(system_identifier)
@@ -178,10 +229,11 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
                         })
 
                     for fieldName in inverter_data:
-                        facts.append(Fact(fieldName,
-                                        inverterContext,
-                                        self.lookUpUnit(fieldName),
-                                        inverter_data[fieldName]))
+                        yield Fact(fieldName,
+                                   inverterContext,
+                                   self.lookUpUnit(fieldName),
+                                   inverter_data[fieldName],
+                                   self.lookUpDecimals(fieldName))
                     # could also add a fact that "TypeOfDevice" = "InverterMember"
             else:
                 print "Warning: No inverter data for {}".format(system_identifier)
@@ -216,13 +268,14 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
                             })
                             # TODO should these be "period: forever" or some other
                             # timeframe?
-                        facts.append(Fact(concept,
-                                          monthly_context,
-                                          self.lookUpUnit(concept),
-                                          value))
+                        yield Fact(concept,
+                                   monthly_context,
+                                   self.lookUpUnit(concept),
+                                   value,
+                                   self.lookUpDecimals(concept))
 
             # Latitude and Longitude go in the SiteIdentifierTable:
-            siteId = "site for {}".format(system_identifier)
+            siteId = site_identifier(system_identifier)
             siteData = self.sites[system_identifier]
             siteContext = self.getContext(
                 "SiteIdentifierTable",
@@ -230,10 +283,11 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
                     "SiteIdentifierAxis": siteId
                 })
             for fieldName in siteData:
-                facts.append(Fact(fieldName,
-                                  siteContext,
-                                  self.lookUpUnit(fieldName),
-                                  siteData[fieldName]))
+                yield Fact(fieldName,
+                           siteContext,
+                           self.lookUpUnit(fieldName),
+                           siteData[fieldName],
+                           self.lookUpDecimals(fieldName))
 
             # The link between the SiteIdentifierTable and the PVSystemTable is the the SiteIdentifierAxis (on the site table) and the SiteIdentifer (as a line item in the pv system table). The value of the SiteIdentifierAxis will be the same as the value of the SiteIdentifier fact. This link is not obvious. I was just speaking to Campbell about it. He is adding an "identification" relationship that will make this easier to see. You are correct, that you put the site identifier value in the SiteIdentifery line item.
 
@@ -245,17 +299,16 @@ class SystemInstallationSheet(AbstractSolarXBRLInstance):
                     # do i need EstimationPeriodStartDateAxis?
                 })
             # make a fact connecting the system to the site:
-            facts.append(Fact("SiteIdentifier",
-                              systemContext,
-                              None,
-                              siteId))
+            yield Fact("SiteIdentifier",
+                       systemContext,
+                       None,
+                       siteId)
             for fieldName in systemData:
-                facts.append(Fact(fieldName,
-                                  systemContext,
-                                  self.lookUpUnit(fieldName),
-                                  systemData[fieldName]))
-
-        return facts
+                yield Fact(fieldName,
+                           systemContext,
+                           self.lookUpUnit(fieldName),
+                           systemData[fieldName],
+                           self.lookUpDecimals(fieldName))
 
 
 
@@ -266,8 +319,9 @@ class MonthlyOperatingReport(AbstractSolarXBRLInstance):
     (expectedkwh) for one or more systems for one or more months.
     """
     # TODO use "100825 - Documents - Monthly Operating Report" ?
-    def __init__(self, entity_name="A Company"):
-        super(MonthlyOperatingReport, self).__init__(entity_name)
+    def __init__(self, entity_name="A Company", context_store=None):
+        super(MonthlyOperatingReport, self).__init__(entity_name,
+                                                     context_store)
         self._data = []
 
     def addData(self, system_name, prod_month, actualkwh, expectedkwh):
@@ -276,12 +330,42 @@ class MonthlyOperatingReport(AbstractSolarXBRLInstance):
                            "actualkwh": actualkwh,
                            "expectedkwh": expectedkwh})
 
+    def addTimeSeriesData(self, system_name, start, frequency, actualkwh,
+                          expectedkwh=None):
+        """
+        Adds production for many consecutive periods at once, e.g. a year
+        of hourly values. actualkwh and expectedkwh are arrays with one
+        value per period; frequency is "hourly", "daily", "monthly" or a
+        timedelta. See AbstractXBRLInstance.addTimeSeries.
+        """
+        dimensions = {"PVSystemIdentifierAxis": system_name}
+        self.addTimeSeries("SystemProductionTable", "MeasuredEnergy",
+                           start, frequency, actualkwh, "kWh", dimensions)
+        if expectedkwh is not None:
+            self.addTimeSeries("SystemProductionTable",
+                               "PredictedEnergyAtTheRevenueMeterDuration",
+                               start, frequency, expectedkwh, "kWh",
+                               dimensions)
+
+    def addPortfolioTotals(self, aggregate="sum"):
+        """
+        Adds the total actual and expected production of all systems for
+        each period, in SystemProductionTable contexts without the
+        PVSystemIdentifierAxis dimension. See
+        AbstractXBRLInstance.addRollUp.
+        """
+        for concept in ["MeasuredEnergy",
+                        "PredictedEnergyAtTheRevenueMeterDuration"]:
+            self.addRollUp(concept, "SystemProductionTable", aggregate)
+
     def get_required_units(self):
         return ["kWh"]
 
     def get_facts(self):
+        return list(self.iter_facts())
+
+    def iter_facts(self):
         # Add an actual and an expected fact for each system-month:
-        facts = []
         for record in self._data:
             system_name = record["system_name"]
             prod_month = record["prod_month"]
@@ -303,15 +387,14 @@ class MonthlyOperatingReport(AbstractSolarXBRLInstance):
                 }
             )
 
-            facts.append(Fact("MeasuredEnergy",
-                              context,
-                              "kWh",
-                              record["actualkwh"]))
-            facts.append(Fact("PredictedEnergyAtTheRevenueMeterDuration",
-                              context,
-                              "kWh",
-                              record["expectedkwh"]))
-        return facts
+            yield Fact("MeasuredEnergy",
+                       context,
+                       "kWh",
+                       record["actualkwh"])
+            yield Fact("PredictedEnergyAtTheRevenueMeterDuration",
+                       context,
+                       "kWh",
+                       record["expectedkwh"])
 
 # TODO: Add clases for FinancialTransaction, FinancialMetadata, and Aging reports.
 # 
@@ -0,0 +1,226 @@
+# Copyright 2018 kWh Analytics
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# pyou may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+import threading
+import Queue
+import StringIO
+import xml.etree.ElementTree
+
+from xbrl_generator import XMLWriter
+
+
+class _Part(object):
+    # The facts of one output document, with the contexts and units they
+    # reference and everything already serialized.
+    def __init__(self, number, filename, first_fact, base_bytes):
+        self.number = number
+        self.filename = filename
+        self.first_fact = first_fact
+        self.facts = []
+        self.fact_xml = {}
+        self.contexts = {}
+        self.context_xml = {}
+        self.units = set()
+        self.bytes = base_bytes
+
+    def cost(self, fact, fact_xml, unit_bytes):
+        """
+        Returns how many bytes adding the fact would add to me, and the
+        XML of its context if I don't have that context yet (else None).
+        """
+        added_bytes = len(fact_xml)
+        context_xml = None
+        if fact.context.get_id() not in self.contexts:
+            context_xml = xml.etree.ElementTree.tostring(fact.context.toXML())
+            added_bytes += len(context_xml)
+        if fact.units is not None and fact.units not in self.units:
+            added_bytes += unit_bytes[fact.units]
+        return added_bytes, context_xml
+
+    def add(self, fact, fact_xml, added_bytes, context_xml):
+        if context_xml is not None:
+            self.contexts[fact.context.get_id()] = fact.context
+            self.context_xml[fact.context.get_id()] = context_xml
+        if fact.units is not None:
+            self.units.add(fact.units)
+        self.facts.append(fact)
+        self.fact_xml[id(fact)] = fact_xml
+        self.bytes += added_bytes
+
+
+def _context_order(context):
+    # The order of a single-document export: by table, then by ID.
+    tableName, serial = context.get_id().rsplit("_", 1)
+    return (tableName, int(serial))
+
+
+class _PartFragments(object):
+    # Serves the XML that was serialized while splitting to an XMLWriter,
+    # in place of SharedFragments.
+    def __init__(self, part):
+        self.part = part
+
+    def context_xml(self, context):
+        return self.part.context_xml[context.get_id()]
+
+    def fact_xml(self, fact):
+        return self.part.fact_xml[id(fact)]
+
+
+def _write_part(instance, part):
+    writer = XMLWriter(part.filename)
+    units = sorted(part.units)
+    writer.begin(instance, units)
+    fragments = _PartFragments(part)
+    for context in sorted(part.contexts.values(), key=_context_order):
+        writer.context(context, fragments)
+    writer.units(units)
+    for fact in part.facts:
+        writer.fact(fact, fragments)
+    writer.end()
+    if writer.outfile.bytes_written != part.bytes:
+        raise Exception("Part {} came out at {} bytes, expected {}".format(
+            part.filename, writer.outfile.bytes_written, part.bytes))
+
+
+def _empty_document_bytes(instance):
+    buf = StringIO.StringIO()
+    writer = XMLWriter(buf)
+    writer.begin(instance, [])
+    writer.end()
+    return len(buf.getvalue())
+
+
+def write_parts(instance, filename_pattern, manifest_filename, max_bytes=None,
+                max_facts=None, threads=4):
+    """
+    Exports the instance as several XBRL-XML documents, each at most
+    max_bytes long and/or with at most max_facts facts, e.g.
+    write_parts(report, "report_part{:03d}.xml", "report_manifest.json",
+    max_bytes=10 * 1024 * 1024).
+
+    filename_pattern is formatted with the part number, starting at 1.
+    Each part is a complete document with only the contexts and units its
+    own facts reference; facts keep their document order. Parts are
+    handed to up to threads writer threads as soon as they are full, so
+    at most about threads + 1 parts are held in memory at once.
+
+    Writes a JSON manifest to manifest_filename describing the split,
+    and returns it as a dictionary. Raises an exception if a single fact
+    with its context and unit doesn't fit in max_bytes.
+    """
+    if max_bytes is None and max_facts is None:
+        raise Exception("Give max_bytes and/or max_facts")
+    if instance.context_store is not None:
+        instance.spillFacts()
+        facts = instance.context_store.iter_facts(instance.hypercubes)
+    else:
+        facts = instance.iter_all_facts()
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_filename))
+    base_bytes = _empty_document_bytes(instance)
+    unit_bytes = {}
+
+    # Full parts go through a bounded queue to the writer threads; errors
+    # are collected and raised here.
+    work = Queue.Queue(maxsize=threads)
+    failures = []
+    done = object()
+
+    def worker():
+        while True:
+            part = work.get()
+            if part is done:
+                return
+            try:
+                _write_part(instance, part)
+            except Exception:
+                failures.append((part.number, sys.exc_info()))
+
+    writers = [threading.Thread(target=worker) for i in range(threads)]
+    for writer in writers:
+        writer.daemon = True
+        writer.start()
+
+    manifest_parts = []
+    part = None
+    fact_number = 0
+
+    def finish(part):
+        work.put(part)
+        manifest_parts.append({
+            "part": part.number,
+            "filename": os.path.relpath(os.path.abspath(part.filename),
+                                        manifest_dir),
+            "first_fact": part.first_fact,
+            "facts": len(part.facts),
+            "contexts": len(part.contexts),
+            "units": sorted(part.units),
+            "bytes": part.bytes})
+
+    try:
+        for fact in facts:
+            if failures:
+                break
+            if fact.units is not None and fact.units not in unit_bytes:
+                unit_bytes[fact.units] = len(xml.etree.ElementTree.tostring(
+                    instance.makeUnitTag(fact.units)))
+            fact_xml = fact.toXMLString()
+            if part is not None:
+                added_bytes, context_xml = part.cost(fact, fact_xml,
+                                                     unit_bytes)
+                if (max_facts is not None and len(part.facts) >= max_facts) \
+                        or (max_bytes is not None and
+                            part.bytes + added_bytes > max_bytes):
+                    finish(part)
+                    part = None
+            if part is None:
+                number = len(manifest_parts) + 1
+                part = _Part(number, filename_pattern.format(number),
+                             fact_number, base_bytes)
+                added_bytes, context_xml = part.cost(fact, fact_xml,
+                                                     unit_bytes)
+                if max_bytes is not None and \
+                        part.bytes + added_bytes > max_bytes:
+                    raise Exception(
+                        "Fact {} ({}) needs {} bytes, more than max_bytes"
+                        .format(fact_number, fact.concept,
+                                part.bytes + added_bytes))
+            part.add(fact, fact_xml, added_bytes, context_xml)
+            fact_number += 1
+        if part is not None and not failures:
+            finish(part)
+    finally:
+        for writer in writers:
+            work.put(done)
+        for writer in writers:
+            writer.join()
+    if failures:
+        exc_info = min(failures)[1]
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    manifest = {
+        "entity": instance.entity_name,
+        "taxonomy": instance.taxonomy,
+        "max_bytes": max_bytes,
+        "max_facts": max_facts,
+        "total_facts": fact_number,
+        "total_bytes": sum(p["bytes"] for p in manifest_parts),
+        "parts": manifest_parts
+    }
+    with open(manifest_filename, "w") as outfile:
+        json.dump(manifest, outfile, indent=2, sort_keys=True)
+    return manifest
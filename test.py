@@ -14,34 +14,44 @@
 
 import unittest
 import datetime
-import shutil
-import urllib2
+import gc
+import json
+import os
 import os.path
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import StringIO
+import BaseHTTPServer
+import SocketServer
+import urlparse
 
 from lxml import etree
+from xml.etree import ElementTree
 
 from solar_document_types import SystemInstallationSheet
 from solar_document_types import MonthlyOperatingReport
+from xbrl_generator import XMLWriter, JSONWriter, Fact
+from context_store import SQLiteContextStore
+from db_ingest import CursorIngest
+from value_formatters import FormatterRegistry
+import xbrl_diff
+import checkpoint
+import split_export
 
 from orange_config import VALIDATION_TARGET_DIR, VALIDATION_API_URL
 from unit_map import UNIT_MAP
 from example_concept_map import EXAMPLE_CONCEPT_MAP
+from validation_client import ArelleValidationClient, ValidationError
 
 
 def pipe_to_arelle_server(xml_filename):
-    # copy the file to the ixbrl directory
-    shutil.copy2(xml_filename, os.path.join(VALIDATION_TARGET_DIR, "ixbrl"))
-
     # GET request to localhost:8080 where Arelle container is running:
-    validation_url = "%s%s" % (VALIDATION_API_URL, xml_filename)
-    result = urllib2.urlopen(validation_url)
-    lines = result.readlines()
-    tree = etree.fromstring( "\n".join(lines[1:]) ) # Skip blank line at beginning
-
-    # Get text from all table cells:
-    table_rows = [x.text for x in tree.iterdescendants() if 'td' in x.tag]
-    table_rows = [x.strip("\n") for x in table_rows]
-    return table_rows
+    client = ArelleValidationClient(VALIDATION_API_URL, VALIDATION_TARGET_DIR)
+    return client.validate(xml_filename).table_rows
 
 
 
@@ -99,5 +109,868 @@ class MonthlyOperatingReportXBRLTest(unittest.TestCase):
 
 
 
+class TrackerReport(MonthlyOperatingReport):
+    def getConceptDatatypes(self):
+        return {"TrackerStyle": "enum"}
+
+    def getConceptEnums(self):
+        return {"TrackerStyle": ["Fixed", "SingleAxis"]}
+
+
+class FormatterTest(unittest.TestCase):
+    def test_formats_by_unit_and_datatype(self):
+        registry = FormatterRegistry({"SystemCommercialOperationsDate": "date",
+                                      "IsTracking": "boolean",
+                                      "TrackerStyle": "enum"},
+                                     {"TrackerStyle": ["Fixed", "SingleAxis"]})
+        kw = registry.get("ModuleNameplateCapacity", "kW", 2)
+        self.assertEqual(kw.decimals, "2")
+        self.assertEqual(kw.format(4.5), "4.50")
+        self.assertEqual(kw.format(1.0 / 3), "0.33")
+        pure = registry.get("EquipmentTypeNumber", "pure", 2)
+        self.assertEqual(pure.decimals, "0")
+        self.assertEqual(pure.format(2.0), "2")
+        date = registry.get("SystemCommercialOperationsDate", None, 2)
+        self.assertEqual(date.decimals, None)
+        self.assertEqual(date.format(datetime.datetime(2018, 1, 21, 8)),
+                         "2018-01-21")
+        self.assertEqual(date.format("2018-01-21"), "2018-01-21")
+        self.assertEqual(registry.get("IsTracking", None, 2).format(True),
+                         "true")
+        tracker = registry.get("TrackerStyle", None, 2)
+        self.assertEqual(tracker.format("Fixed"), "Fixed")
+        self.assertRaises(Exception, tracker.format, "Wobbly")
+        self.assertTrue(registry.get("ModuleNameplateCapacity", "kW", 2) is kw)
+
+    def test_instance_enums(self):
+        report = TrackerReport()
+        context = report.getContext("PVSystemTable")
+        fact = Fact("TrackerStyle", context, None, "SingleAxis")
+        self.assertEqual(fact.toXMLString(), '<solar:TrackerStyle contextRef='
+                         '"PVSystemTable_0">SingleAxis</solar:TrackerStyle>')
+        fact = Fact("TrackerStyle", context, None, "Wobbly")
+        self.assertRaises(Exception, fact.toXMLString)
+
+    def test_xml_and_json_agree(self):
+        sheet = SystemInstallationSheet(UNIT_MAP, EXAMPLE_CONCEPT_MAP)
+        sheet.addSystem(1, {"installer": "Us",
+                            "COD": datetime.datetime(2018, 1, 21)})
+        sheet.addSite(1, {"latitude": 42.3601, "longitude": -71})
+        xml = sheet.toXMLString()
+        self.assertTrue(">2018-01-21</solar:SystemCommercialOperationsDate>"
+                        in xml)
+        self.assertTrue('decimals="6"' in xml)
+        self.assertTrue(">42.360100</solar:SiteLatitudeAtSystemEntrance>"
+                        in xml)
+        values = set(fact["value"] for fact in
+                     json.loads(sheet.toJSONString())["facts"])
+        self.assertTrue("2018-01-21" in values)
+        self.assertTrue("-71.000000" in values)
+
+
+class TimeSeriesTest(unittest.TestCase):
+    def test_hourly_series(self):
+        report = MonthlyOperatingReport()
+        actual = [float(hour) for hour in range(48)]
+        actual[5] = float("nan")
+        report.addTimeSeriesData("sys1", datetime.datetime(2018, 3, 1),
+                                 "hourly", actual, [10.0] * 48)
+        report.addTimeSeriesData("sys2", datetime.datetime(2018, 3, 1),
+                                 "hourly", actual)
+        facts = list(report.iter_all_facts())
+        self.assertEqual(len(facts), 47 + 48 + 47)
+        contexts = report.hypercubes["SystemProductionTable"].contexts
+        self.assertEqual(len(contexts), 96)
+        self.assertEqual(facts[0].context.duration,
+                         (datetime.datetime(2018, 3, 1, 0),
+                          datetime.datetime(2018, 3, 1, 1)))
+        xml = report.toXMLString()
+        self.assertTrue("<startDate>2018-03-01T23:00:00</startDate>"
+                        "<endDate>2018-03-02T00:00:00</endDate>" in xml)
+        self.assertEqual(xml.count("<solar:MeasuredEnergy "), 94)
+
+    def test_none_is_missing_data(self):
+        # Gaps as they come out of a plain list or a database column:
+        report = MonthlyOperatingReport()
+        report.addTimeSeriesData("sys1", datetime.date(2018, 1, 1), "daily",
+                                 [1, None, 3])
+        report.addRollUp("MeasuredEnergy", target_concept="Total")
+        facts = list(report.iter_time_series_facts())
+        self.assertEqual([fact.value for fact in facts], [1, 3])
+        totals = [fact.value for fact in report.iter_all_facts()
+                  if fact.concept == "Total"]
+        self.assertEqual(totals, [1.0, 3.0])
+        self.assertFalse(">None<" in report.toXMLString())
+
+    def test_export_streams_series_facts(self):
+        report = MonthlyOperatingReport()
+        report.addData("sys1", datetime.date(2018, 1, 1), 1000, 1100)
+        report.addTimeSeriesData("sys1", datetime.datetime(2018, 1, 1),
+                                 "hourly", [1.0] * 2000, [2.0] * 2000)
+        report.addPortfolioTotals()
+        buf = StringIO.StringIO()
+        writer = LiveFactCountingWriter(buf)
+        report.export([writer])
+        self.assertTrue(writer.live_facts < 100)
+        self.assertEqual(buf.getvalue(), ElementTree.tostring(
+            report.toXMLTag()))
+
+    def test_daily_and_monthly_periods(self):
+        report = MonthlyOperatingReport()
+        daily = report.addTimeSeries("SystemProductionTable", "MeasuredEnergy",
+                                     datetime.date(2018, 2, 27), "daily",
+                                     [1, 2, 3], "kWh")
+        self.assertEqual(daily.periods()[2], (datetime.date(2018, 3, 1),
+                                              datetime.date(2018, 3, 1)))
+        monthly = report.addTimeSeries("SystemProductionTable",
+                                       "MeasuredEnergy",
+                                       datetime.date(2018, 1, 1), "monthly",
+                                       [1, 2], "kWh")
+        self.assertEqual(monthly.periods()[1], (datetime.date(2018, 2, 1),
+                                                datetime.date(2018, 2, 28)))
+        self.assertRaises(Exception, report.addTimeSeries,
+                          "SystemProductionTable", "MeasuredEnergy",
+                          datetime.date(2018, 1, 1), "hourly", [1])
+
+
+class RollUpTest(unittest.TestCase):
+    def rollup_facts(self, report):
+        return [fact for fact in report.iter_all_facts()
+                if "PVSystemIdentifierAxis" not in
+                fact.context.extra_dimensions]
+
+    def test_portfolio_totals(self):
+        report = MonthlyOperatingReport()
+        report.addData("sys1", datetime.date(2018, 1, 1), 100, 110)
+        report.addData("sys1", datetime.date(2018, 2, 1), 200, 210)
+        report.addData("sys2", datetime.date(2018, 1, 1), 1000, 1100)
+        # A monthly time series lands in the same roll-up contexts:
+        report.addTimeSeriesData("sys3", datetime.date(2018, 1, 1), "monthly",
+                                 [1.5, float("nan")], [2.5, 3.5])
+        report.addPortfolioTotals()
+        totals = dict(((fact.concept, fact.context.duration[0].month),
+                       fact.value) for fact in self.rollup_facts(report))
+        self.assertEqual(totals, {
+            ("MeasuredEnergy", 1): 1101.5,
+            ("MeasuredEnergy", 2): 200.0,
+            ("PredictedEnergyAtTheRevenueMeterDuration", 1): 1212.5,
+            ("PredictedEnergyAtTheRevenueMeterDuration", 2): 213.5})
+        xml = report.toXMLString()
+        self.assertTrue(">1101.50</solar:MeasuredEnergy>" in xml)
+
+    def test_aggregates_of_hourly_series(self):
+        report = MonthlyOperatingReport()
+        start = datetime.datetime(2018, 3, 1)
+        report.addTimeSeriesData("sys1", start, "hourly", [1.0, 4.0, 2.0])
+        report.addTimeSeriesData("sys2", start, "hourly", [3.0, 2.0, 6.0])
+        for aggregate in ["mean", "min", "max"]:
+            report.addRollUp("MeasuredEnergy", aggregate=aggregate,
+                             target_concept=aggregate)
+        values = {}
+        for fact in self.rollup_facts(report):
+            values.setdefault(fact.concept, []).append(fact.value)
+        self.assertEqual(values, {"mean": [2.0, 3.0, 4.0],
+                                  "min": [1.0, 2.0, 2.0],
+                                  "max": [3.0, 4.0, 6.0]})
+
+    def test_rejects_duplicate_totals(self):
+        report = MonthlyOperatingReport()
+        report.addData("sys1", datetime.date(2018, 1, 1), 100, 110)
+        report.addPortfolioTotals()
+        self.assertRaises(Exception, report.addPortfolioTotals)
+        self.assertEqual(len([fact for fact in report.iter_all_facts()
+                              if fact.concept == "MeasuredEnergy"]), 2)
+        # A fact that is already a portfolio total:
+        report.addTimeSeries("SystemProductionTable", "MeasuredEnergy",
+                             datetime.date(2018, 1, 1), "monthly", [100.0],
+                             "kWh")
+        self.assertRaises(Exception, list, report.iter_all_facts())
+
+    def test_site_totals(self):
+        sheet = SystemInstallationSheet(UNIT_MAP, EXAMPLE_CONCEPT_MAP)
+        sheet.addSystem(1, {"installer": "These guys I know"})
+        sheet.addSite(1, {"latitude": 42, "longitude": -170})
+        sheet.addArray(1, {"capacity_dc_kw": 4.5})
+        sheet.addArray(1, {"capacity_dc_kw": 5.5})
+        sheet.addInverter(1, {"capacity_ac_kw": 8.0})
+        sheet.addSiteTotals(["ModuleNameplateCapacity"])
+        facts = [fact for fact in sheet.iter_all_facts()
+                 if fact.context.hypercube.tableName == "SiteIdentifierTable"]
+        self.assertEqual([(fact.concept, fact.value) for fact in facts],
+                         [("SiteLatitudeAtSystemEntrance", 42),
+                          ("SiteLongitudeAtSystemEntrance", -170),
+                          ("ModuleNameplateCapacity", 10.0)])
+        self.assertEqual(len(set(fact.context for fact in facts)), 1)
+
+
+class LiveFactCountingWriter(XMLWriter):
+    # Records how many Fact objects exist when the document is begun.
+    def begin(self, instance, units):
+        gc.collect()
+        self.live_facts = len([obj for obj in gc.get_objects()
+                               if isinstance(obj, Fact)])
+        XMLWriter.begin(self, instance, units)
+
+
+class CompactOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def makeSheet(self, context_store=None):
+        sheet = SystemInstallationSheet(UNIT_MAP, EXAMPLE_CONCEPT_MAP,
+                                        context_store=context_store)
+        for system in range(3):
+            sheet.addSystem(system, {"installer": "Us"})
+            sheet.addSite(system, {"latitude": 42, "longitude": -170})
+            sheet.addArray(system, {"tilt": 20, "capacity_dc_kw": 4.5})
+            sheet.addInverter(system, {"capacity_ac_kw": 8.0})
+        return sheet
+
+    def test_reports_bytes_saved(self):
+        for use_store in [False, True]:
+            stores = [SQLiteContextStore(cache_size=2) if use_store else None
+                      for i in range(2)]
+            normal = os.path.join(self.temp_dir, "normal.xml")
+            compact = os.path.join(self.temp_dir, "compact.xml")
+            self.makeSheet(stores[0]).toXML(normal)
+            report = self.makeSheet(stores[1]).toXML(compact, compact=True)
+            self.assertEqual(report.bytes_written, os.path.getsize(compact))
+            self.assertEqual(report.baseline_bytes, os.path.getsize(normal))
+            self.assertTrue(report.bytes_saved > 0)
+
+    def test_compact_document(self):
+        xml = self.makeSheet().toXMLString(compact=True)
+        self.assertEqual(xml, self.makeSheet().toXMLString(compact=True))
+        self.assertFalse("xmlns:xsi" in xml)
+        self.assertTrue("xmlns:xbrldi" in xml)
+        self.assertFalse("Table_" in xml)
+        root = etree.fromstring(xml.replace("xmlns=", "xmlns:default="))
+        ids = set(c.get("id") for c in root if c.tag == "context")
+        refs = set(c.get("contextRef") for c in root if c.get("contextRef"))
+        self.assertTrue("c0" in ids)
+        self.assertEqual(refs - ids, set())
+        for segment in root.iter("segment"):
+            dimensions = [member.get("dimension") for member in segment]
+            self.assertEqual(dimensions, sorted(dimensions))
+
+
+class DiffTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def makeReports(self):
+        old = MonthlyOperatingReport()
+        new = MonthlyOperatingReport()
+        for system in ["sys1", "sys2", "sys3"]:
+            old.addData(system, datetime.date(2018, 1, 1), 1000, 1100)
+        # New month first, so that context IDs no longer line up:
+        new.addData("sys1", datetime.date(2018, 2, 1), 900, 950)
+        new.addData("sys1", datetime.date(2018, 1, 1), 1000, 1100)
+        new.addData("sys2", datetime.date(2018, 1, 1), 1001, 1100)
+        return old, new
+
+    def checkDiff(self, result):
+        self.assertEqual(len(result.added), 2)
+        self.assertEqual(set(d.new_value for d in result.added),
+                         set(["900.00", "950.00"]))
+        self.assertEqual(len(result.removed), 2)
+        self.assertEqual(set(d.dimensions[0][1] for d in result.removed),
+                         set(["sys3"]))
+        self.assertEqual(len(result.changed), 1)
+        change = result.changed[0]
+        self.assertEqual(change.concept,
+                         "{http://xbrl.us/Solar/v1.2/2018-03-31/solar}"
+                         "MeasuredEnergy")
+        self.assertEqual(change.period, "duration:2018-01-01/2018-01-31")
+        self.assertEqual((change.old_value, change.new_value),
+                         ("1000.00", "1001.00"))
+
+    def test_diff_instances(self):
+        old, new = self.makeReports()
+        self.checkDiff(xbrl_diff.diff(old, new))
+        self.assertTrue(xbrl_diff.diff(old, old).is_empty())
+
+    def test_diff_files(self):
+        old, new = self.makeReports()
+        old_file = os.path.join(self.temp_dir, "old.xml")
+        new_file = os.path.join(self.temp_dir, "new.xml")
+        old.toXML(old_file)
+        new.toXML(new_file, compact=True)
+        self.checkDiff(xbrl_diff.diff(old_file, new_file))
+        self.checkDiff(xbrl_diff.diff(old, new_file))
+        self.assertTrue(xbrl_diff.diff(old_file, old).is_empty())
+
+    def test_repeated_facts(self):
+        old = MonthlyOperatingReport()
+        old.addData("sys1", datetime.date(2018, 1, 1), 1000, 1100)
+        old.addData("sys2", datetime.date(2018, 1, 1), 500, 600)
+        new = MonthlyOperatingReport()
+        new.addData("sys1", datetime.date(2018, 1, 1), 900, 1000)
+        new.addData("sys1", datetime.date(2018, 1, 1), 1000, 1100)
+        new.addData("sys2", datetime.date(2018, 1, 1), 500, 600)
+        new.addData("sys2", datetime.date(2018, 1, 1), 501, 600)
+        new.addData("sys3", datetime.date(2018, 1, 1), 1, 2)
+        new.addData("sys3", datetime.date(2018, 1, 1), 3, 2)
+        self.assertTrue(xbrl_diff.diff(new, new).is_empty())
+        # The last value of a repeated fact wins:
+        result = xbrl_diff.diff(old, new)
+        self.assertEqual([(d.old_value, d.new_value) for d in result.changed],
+                         [("500.00", "501.00")])
+        self.assertEqual([d.new_value for d in result.added],
+                         ["3.00", "2.00"])
+        self.assertEqual(result.removed, [])
+        result = xbrl_diff.diff(new, old)
+        self.assertEqual([(d.old_value, d.new_value) for d in result.changed],
+                         [("501.00", "500.00")])
+        self.assertEqual([d.old_value for d in result.removed],
+                         ["3.00", "2.00"])
+
+
+class CountingReport(MonthlyOperatingReport):
+    def __init__(self, *args, **kwargs):
+        super(CountingReport, self).__init__(*args, **kwargs)
+        self.passes = 0
+
+    def iter_facts(self):
+        self.passes += 1
+        return super(CountingReport, self).iter_facts()
+
+
+class MultiFormatExportTest(unittest.TestCase):
+    def test_single_pass(self):
+        report = CountingReport()
+        for system in range(5):
+            report.addData("sys%d" % system, datetime.date(2018, 1, 1),
+                           1000, 1100)
+        xml_buf = StringIO.StringIO()
+        json_buf = StringIO.StringIO()
+        report.export([XMLWriter(xml_buf), JSONWriter(json_buf)])
+        self.assertEqual(report.passes, 1)
+
+        self.assertEqual(xml_buf.getvalue(), report.toXMLString())
+        self.assertEqual(xml_buf.getvalue(),
+                         ElementTree.tostring(report.toXMLTag()))
+        document = json.loads(json_buf.getvalue())
+        self.assertEqual(document, json.loads(report.toJSONString()))
+        self.assertEqual(document["facts"],
+                         [json.loads(json.dumps(fact.toJSON()))
+                          for fact in report.get_facts()])
+
+    def test_element_matches_export_with_several_tables(self):
+        sheet = SystemInstallationSheet(UNIT_MAP, EXAMPLE_CONCEPT_MAP)
+        sheet.addSystem(1, {"installer": "These guys I know",
+                            "COD": "2018-01-21"})
+        sheet.addSite(1, {"latitude": 42, "longitude": -170})
+        sheet.addArray(1, {"tilt": 20, "azimuth": 180,
+                           "capacity_dc_kw": 4.5})
+        sheet.addInverter(1, {"capacity_ac_kw": 8.0})
+        xml = sheet.toXMLString()
+        self.assertTrue(len(sheet.hypercubes) > 1)
+        self.assertEqual(ElementTree.tostring(sheet.toXMLTag()), xml)
+
+    def test_fact_string_matches_element(self):
+        sheet = SystemInstallationSheet(UNIT_MAP, EXAMPLE_CONCEPT_MAP)
+        sheet.addSystem(1, {"installer": u"A & B <\u00e9> \"Co\"",
+                            "COD": ""})
+        sheet.addSite(1, {"latitude": 42, "longitude": -170})
+        for fact in sheet.get_facts():
+            self.assertEqual(fact.toXMLString(),
+                             ElementTree.tostring(fact.toXML()))
+
+
+class SplitExportTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.report = MonthlyOperatingReport()
+        for system in range(20):
+            for month in range(1, 13):
+                self.report.addData("sys%d" % system,
+                                    datetime.date(2018, month, 1),
+                                    1000 + month, 1100 + system)
+        self.report.addTimeSeriesData("sys0", datetime.datetime(2018, 1, 1),
+                                      "hourly", [1.5] * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_parts(self, **kwargs):
+        return split_export.write_parts(
+            self.report, os.path.join(self.temp_dir, "part{:03d}.xml"),
+            os.path.join(self.temp_dir, "manifest.json"), **kwargs)
+
+    def check_parts(self, manifest):
+        all_facts = []
+        for part in manifest["parts"]:
+            filename = os.path.join(self.temp_dir, part["filename"])
+            self.assertEqual(os.path.getsize(filename), part["bytes"])
+            root = etree.parse(filename).getroot()
+            context_ids = set(elem.get("id") for elem in root
+                              if elem.tag.endswith("}context"))
+            unit_ids = set(elem.get("id") for elem in root
+                           if elem.tag.endswith("}unit"))
+            facts = [elem for elem in root if elem.get("contextRef")]
+            self.assertEqual(len(facts), part["facts"])
+            # Exactly the contexts and units the part's facts reference:
+            self.assertEqual(context_ids,
+                             set(elem.get("contextRef") for elem in facts))
+            self.assertEqual(unit_ids,
+                             set(elem.get("unitRef") for elem in facts))
+            all_facts.extend((elem.get("contextRef"), elem.tag, elem.text)
+                             for elem in facts)
+        return all_facts
+
+    def test_byte_budget(self):
+        whole = etree.fromstring(self.report.toXMLString())
+        expected = [(elem.get("contextRef"), elem.tag, elem.text)
+                    for elem in whole if elem.get("contextRef")]
+        manifest = self.write_parts(max_bytes=8000, threads=3)
+        self.assertTrue(len(manifest["parts"]) > 5)
+        for part in manifest["parts"]:
+            self.assertTrue(part["bytes"] <= 8000)
+        self.assertEqual(self.check_parts(manifest), expected)
+        with open(os.path.join(self.temp_dir, "manifest.json")) as infile:
+            self.assertEqual(json.load(infile)["total_facts"], len(expected))
+
+    def test_fact_budget(self):
+        manifest = self.write_parts(max_facts=100)
+        self.assertEqual([part["facts"] for part in manifest["parts"]],
+                         [100, 100, 100, 100, 100, 80])
+        self.assertEqual(len(self.check_parts(manifest)), 580)
+
+    def test_fact_too_big(self):
+        self.assertRaises(Exception, self.write_parts, max_bytes=1000)
+
+
+class ContextStoreTest(unittest.TestCase):
+    def fillReport(self, report):
+        for system in range(20):
+            for month in range(1, 13):
+                report.addData("sys%d" % system,
+                               datetime.date(2018, month, 1),
+                               1000 + month, 900 + system)
+
+    def test_matches_in_memory_output(self):
+        inMemory = MonthlyOperatingReport()
+        self.fillReport(inMemory)
+
+        store = SQLiteContextStore(cache_size=5, batch_size=7)
+        onDisk = MonthlyOperatingReport(context_store=store)
+        self.fillReport(onDisk)
+
+        self.assertEqual(onDisk.toXMLString(), inMemory.toXMLString())
+        self.assertEqual(json.loads(onDisk.toJSONString()),
+                         json.loads(inMemory.toJSONString()))
+        self.assertEqual(store.count_contexts("SystemProductionTable"), 240)
+        self.assertEqual(store.count_facts(), 480)
+        self.assertTrue(len(store._by_key) <= 5)
+        store.close()
+        self.assertFalse(os.path.exists(store.filename))
+
+    def test_reuses_stored_contexts(self):
+        store = SQLiteContextStore(cache_size=1)
+        report = MonthlyOperatingReport(context_store=store)
+        first = report.getContext("SystemProductionTable",
+                                  extra_dimensions={"PVSystemIdentifierAxis": "a"})
+        report.getContext("SystemProductionTable",
+                          extra_dimensions={"PVSystemIdentifierAxis": "b"})
+        again = report.getContext("SystemProductionTable",
+                                  extra_dimensions={"PVSystemIdentifierAxis": "a"})
+        self.assertEqual(again.get_id(), first.get_id())
+        self.assertEqual(store.count_contexts("SystemProductionTable"), 2)
+        store.close()
+
+
+class CursorIngestTest(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:", check_same_thread=False,
+                                  detect_types=sqlite3.PARSE_DECLTYPES)
+        self.db.execute("CREATE TABLE production (system TEXT, month DATE,"
+                        " actual REAL, expected REAL)")
+        for system in range(5):
+            for month in range(1, 13):
+                self.db.execute("INSERT INTO production VALUES (?, ?, ?, ?)",
+                                ("sys%d" % system,
+                                 datetime.date(2018, month, 1),
+                                 1000.0 + month, 1000.0))
+        self.db.execute("CREATE TABLE systems (id INTEGER, installer TEXT,"
+                        " cod TEXT)")
+        self.db.execute("INSERT INTO systems VALUES (1, 'Those guys', NULL)")
+        self.db.execute("INSERT INTO systems VALUES (2, 'Us', '2018-01-21')")
+
+    def tearDown(self):
+        self.db.close()
+
+    def ingestProduction(self, background):
+        cursor = self.db.execute("SELECT * FROM production")
+        report = MonthlyOperatingReport()
+        ingest = CursorIngest(cursor, "addData",
+                              {"system": "system_name",
+                               "month": "prod_month",
+                               "actual": "actualkwh",
+                               "expected": "expectedkwh"},
+                              batch_size=7, background=background)
+        self.assertEqual(ingest.ingest(report), 60)
+        return report
+
+    def test_feeds_report_in_batches(self):
+        for background in [False, True]:
+            report = self.ingestProduction(background)
+            self.assertEqual(len(report.get_facts()), 120)
+            self.assertEqual(report._data[13]["prod_month"],
+                             datetime.date(2018, 2, 1))
+            self.assertEqual(report._data[13]["system_name"], "sys1")
+
+    def test_maps_columns_to_facts(self):
+        cursor = self.db.execute("SELECT * FROM systems")
+        sheet = SystemInstallationSheet(UNIT_MAP, EXAMPLE_CONCEPT_MAP)
+        ingest = CursorIngest(cursor, "addSystem", {"id": "systemid"},
+                              fact_columns={"installer": "installer",
+                                            "cod": "COD"})
+        ingest.ingest(sheet)
+        self.assertEqual(sheet.systems[1],
+                         {"SystemInstallerCompany": "Those guys"})
+        self.assertEqual(sheet.systems[2],
+                         {"SystemInstallerCompany": "Us",
+                          "SystemCommercialOperationsDate": "2018-01-21"})
+
+    def test_reports_fetch_errors(self):
+        class BrokenCursor(object):
+            description = [("system",), ("month",), ("actual",), ("expected",)]
+            def fetchmany(self, size):
+                raise sqlite3.OperationalError("connection lost")
+        ingest = CursorIngest(BrokenCursor(), "addData",
+                              {"system": "system_name"})
+        self.assertRaises(sqlite3.OperationalError, ingest.ingest,
+                          MonthlyOperatingReport())
+
+    def test_stops_fetching_when_adding_fails(self):
+        def add(instance, **kwargs):
+            raise ValueError("bad row")
+        cursor = self.db.execute("SELECT * FROM production")
+        ingest = CursorIngest(cursor, add, {"system": "system_name"},
+                              batch_size=1, queue_depth=1)
+        threads = threading.active_count()
+        try:
+            ingest.ingest(MonthlyOperatingReport())
+            self.fail("ingest should have raised")
+        except ValueError:
+            # The fetching thread is gone before the caller handles it:
+            self.assertEqual(threading.active_count(), threads)
+
+
+class ConcurrentIngestTest(unittest.TestCase):
+    tables = ["SystemProductionTable", "PVSystemTable", "SiteIdentifierTable"]
+
+    def produce(self, instance, threads, per_thread):
+        # Every thread asks for the same contexts, in a different order, so
+        # that most calls race another thread for the same context.
+        def work(offset):
+            for i in range(per_thread):
+                n = (i + offset) % per_thread
+                instance.getContext(
+                    self.tables[n % 3],
+                    duration=(datetime.date(2018, 1, 1),
+                              datetime.date(2018, 1, 31)),
+                    extra_dimensions={"PVSystemIdentifierAxis": n // 3})
+        workers = [threading.Thread(target=work, args=(t * 97,))
+                   for t in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def checkContexts(self, instance, per_thread):
+        self.assertEqual(sorted(instance.hypercubes.keys()),
+                         sorted(self.tables))
+        total = 0
+        for table, cube in instance.hypercubes.items():
+            contexts = list(cube.iter_contexts())
+            ids = [context.get_id() for context in contexts]
+            keys = [context.get_key() for context in contexts]
+            self.assertEqual(len(set(ids)), len(ids))
+            self.assertEqual(len(set(keys)), len(keys))
+            total += len(contexts)
+        self.assertEqual(total, per_thread)
+
+    def test_stress(self):
+        per_thread = 3000
+        for threads in [1, 2, 4, 8]:
+            report = MonthlyOperatingReport()
+            self.produce(report, threads, per_thread)
+            self.checkContexts(report, per_thread)
+
+    def test_stress_with_store(self):
+        store = SQLiteContextStore(cache_size=100, batch_size=50)
+        report = MonthlyOperatingReport(context_store=store)
+        self.produce(report, 4, 600)
+        self.checkContexts(report, 600)
+        store.close()
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.temp_dir, "report.ckpt")
+        self.db = sqlite3.connect(":memory:", check_same_thread=False,
+                                  detect_types=sqlite3.PARSE_DECLTYPES)
+        self.db.execute("CREATE TABLE production (system TEXT, month DATE,"
+                        " actual REAL, expected REAL)")
+        for system in range(4):
+            for month in range(1, 13):
+                self.db.execute("INSERT INTO production VALUES (?, ?, ?, ?)",
+                                ("sys%d" % system,
+                                 datetime.date(2018, month, 1),
+                                 1000.0 + month, 1000.0 + system))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.temp_dir)
+
+    def ingest(self, report, checkpointer=None, fail_after=None):
+        def add(instance, **kwargs):
+            if fail_after is not None and len(instance._data) >= fail_after:
+                raise KeyboardInterrupt("preempted")
+            instance.addData(**kwargs)
+        cursor = self.db.execute("SELECT * FROM production ORDER BY rowid")
+        CursorIngest(cursor, add,
+                     {"system": "system_name", "month": "prod_month",
+                      "actual": "actualkwh", "expected": "expectedkwh"},
+                     batch_size=5, background=False, name="production",
+                     checkpointer=checkpointer).ingest(report)
+
+    def test_resume_after_preemption(self):
+        expected = MonthlyOperatingReport()
+        self.ingest(expected)
+
+        report = MonthlyOperatingReport()
+        report.addTimeSeriesData("sys0", datetime.datetime(2018, 1, 1),
+                                 "hourly", [1.0, 2.0, 3.0])
+        report.getContext("PVSystemTable",
+                          extra_dimensions={"PVSystemIdentifierAxis": "x"})
+        checkpointer = checkpoint.Checkpointer(report, self.snapshot,
+                                               every_rows=10)
+        self.assertRaises(KeyboardInterrupt, self.ingest, report,
+                          checkpointer, 33)
+        self.assertEqual(checkpointer.saves, 3)
+
+        resumed = checkpoint.resume(self.snapshot)
+        self.assertEqual(resumed.progress["production"], 30)
+        self.assertEqual(len(resumed._data), 30)
+        context = resumed.getContext(
+            "PVSystemTable", extra_dimensions={"PVSystemIdentifierAxis": "x"})
+        self.assertEqual(context.get_id(), "PVSystemTable_0")
+        self.ingest(resumed)
+        self.assertEqual(resumed._data, expected._data)
+        self.assertEqual(len(resumed.get_facts()), 96)
+        self.assertEqual(len(list(resumed.iter_all_facts())), 99)
+
+    def test_resume_with_context_store(self):
+        store_file = os.path.join(self.temp_dir, "contexts.sqlite")
+        store = SQLiteContextStore(store_file)
+        report = MonthlyOperatingReport(context_store=store)
+        first = report.getContext(
+            "PVSystemTable", extra_dimensions={"PVSystemIdentifierAxis": "x"})
+        checkpoint.save_checkpoint(report, self.snapshot)
+        store.close()
+
+        resumed = checkpoint.resume(self.snapshot)
+        again = resumed.getContext(
+            "PVSystemTable", extra_dimensions={"PVSystemIdentifierAxis": "x"})
+        other = resumed.getContext(
+            "PVSystemTable", extra_dimensions={"PVSystemIdentifierAxis": "y"})
+        self.assertEqual(again.get_id(), first.get_id())
+        self.assertEqual(other.get_id(), "PVSystemTable_1")
+        resumed.context_store.close()
+        self.assertTrue(os.path.exists(store_file))
+
+    def test_resume_in_another_process(self):
+        store_file = os.path.join(self.temp_dir, "contexts.sqlite")
+        store = SQLiteContextStore(store_file)
+        report = MonthlyOperatingReport(context_store=store)
+        report.getContext("PVSystemTable", duration=(datetime.date(2018, 1, 1),
+                                                     datetime.date(2018, 1, 31)),
+                          extra_dimensions={"PVSystemIdentifierAxis": "x"})
+        checkpoint.save_checkpoint(report, self.snapshot)
+        mode = store._conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+        store.close()
+        # A new process, with different string hashes, finds the context:
+        script = ("import checkpoint, datetime\n"
+                  "report = checkpoint.resume(%r)\n"
+                  "print report.getContext('PVSystemTable', duration=("
+                  "datetime.date(2018, 1, 1), datetime.date(2018, 1, 31)),"
+                  " extra_dimensions={'PVSystemIdentifierAxis': u'x'})"
+                  ".get_id()\n" % self.snapshot)
+        output = subprocess.check_output([sys.executable, "-R", "-c", script])
+        self.assertEqual(output.strip(), "PVSystemTable_0")
+
+    def test_contexts_added_after_checkpoint_are_dropped(self):
+        store_file = os.path.join(self.temp_dir, "contexts.sqlite")
+        store = SQLiteContextStore(store_file)
+        report = MonthlyOperatingReport(context_store=store)
+        dimensions = lambda system: {"PVSystemIdentifierAxis": system}
+        report.getContext("PVSystemTable", extra_dimensions=dimensions("a"))
+        checkpoint.save_checkpoint(report, self.snapshot)
+        # Work done after the checkpoint and lost to preemption:
+        report.getContext("PVSystemTable", extra_dimensions=dimensions("b"))
+        store.flush()
+        store.close()
+
+        resumed = checkpoint.resume(self.snapshot)
+        resumed.getContext("PVSystemTable", extra_dimensions=dimensions("c"))
+        resumed.getContext("PVSystemTable", extra_dimensions=dimensions("b"))
+        cube = resumed.hypercubes["PVSystemTable"]
+        self.assertEqual(
+            [(context.get_id(),
+              context.extra_dimensions["PVSystemIdentifierAxis"])
+             for context in cube.iter_contexts()],
+            [("PVSystemTable_0", "a"), ("PVSystemTable_1", "c"),
+             ("PVSystemTable_2", "b")])
+        resumed.context_store.close()
+
+
+class StubArelleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Speaks HTTP/1.1 so that connections are kept alive between requests.
+    protocol_version = "HTTP/1.1"
+    default_log_format = "[%(messageCode)s] %(message)s - %(file)s"
+    # (level, message code, message, line) as Arelle logs them:
+    log = [("INFO", "info", "loaded in 0.10 secs", 1),
+           ("ERROR", "xbrl.4.8.2:unitRef", "Fact has no unit", 12),
+           ("INCONSISTENCY", "xbrl.5.2.5.2:calcInconsistency",
+            "Calculation inconsistent from Revenues", 3)]
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            fail = self.server.failures_left > 0
+            if fail:
+                self.server.failures_left -= 1
+        if fail:
+            body = "busy"
+            self.send_response(503)
+        else:
+            query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+            filename = query["file"][0].rsplit("/", 1)[-1]
+            log_format = query.get("logFormat", [self.default_log_format])[0]
+            rows = "".join(
+                "<tr><td>%s</td></tr>" % (log_format % {
+                    "levelname": level, "messageCode": code,
+                    "message": message, "file": "%s %d" % (filename, line)})
+                for level, code, message, line in self.log)
+            body = ("\n<html><body><table><tr><th>Messages</th></tr>%s"
+                    "</table></body></html>" % rows)
+            self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubArelleServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ValidationClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubArelleServer(("127.0.0.1", 0), StubArelleHandler)
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.requests = 0
+        self.server.failures_left = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/rest/xbrl/validation?file=/ixbrl/" % \
+            self.server.server_address[1]
+
+        self.temp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.temp_dir, "ixbrl"))
+        self.filenames = []
+        for i in range(10):
+            filename = os.path.join(self.temp_dir, "doc_%d.xml" % i)
+            with open(filename, "w") as outfile:
+                outfile.write("<xbrl/>")
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_parses_messages(self):
+        client = ArelleValidationClient(self.url, self.temp_dir)
+        result = client.validate(self.filenames[0])
+        self.assertEqual(len(result.table_rows), 3)
+        self.assertEqual(len(result.errors), 1)
+        self.assertEqual(result.errors[0].code, "xbrl.4.8.2:unitRef")
+        self.assertEqual(result.errors[0].message, "Fact has no unit")
+        self.assertEqual(result.errors[0].location, "doc_0.xml 12")
+        self.assertEqual([m.code for m in result.warnings],
+                         ["xbrl.5.2.5.2:calcInconsistency"])
+        self.assertEqual(result.messages[0].level, "info")
+        self.assertFalse(result.is_valid())
+        staged = os.path.join(self.temp_dir, "ixbrl", "doc_0.xml")
+        self.assertTrue(os.path.exists(staged))
+
+    def test_restages_changed_copies(self):
+        client = ArelleValidationClient(self.url, self.temp_dir)
+        staged = os.path.join(self.temp_dir, "ixbrl", "doc_0.xml")
+        # A stale copy (as if hard-linking had failed) with the same size
+        # and mtime as the regenerated document:
+        with open(staged, "w") as outfile:
+            outfile.write("<old/>>")
+        stat = os.stat(self.filenames[0])
+        os.utime(staged, (stat.st_atime, stat.st_mtime))
+        client.validate(self.filenames[0])
+        with open(staged) as infile:
+            self.assertEqual(infile.read(), "<xbrl/>")
+
+    def test_batch_reuses_pooled_connections(self):
+        client = ArelleValidationClient(self.url, self.temp_dir,
+                                        max_connections=3)
+        results = client.validate_many(self.filenames)
+        client.close()
+        self.assertEqual([r.filename for r in results], self.filenames)
+        self.assertEqual(self.server.requests, 10)
+        self.assertTrue(self.server.connections <= 3)
+
+    def test_batch_rejects_clashing_names(self):
+        # Both would be staged as ixbrl/report.xml at the same time.
+        filenames = []
+        for month in ["jan", "feb"]:
+            os.mkdir(os.path.join(self.temp_dir, month))
+            filename = os.path.join(self.temp_dir, month, "report.xml")
+            with open(filename, "w") as outfile:
+                outfile.write("<xbrl><!-- %s --></xbrl>" % month)
+            filenames.append(filename)
+        client = ArelleValidationClient(self.url, self.temp_dir)
+        self.assertRaises(ValidationError, client.validate_many, filenames)
+        self.assertEqual(self.server.requests, 0)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir, "ixbrl", "report.xml")))
+
+    def test_retries_server_errors(self):
+        self.server.failures_left = 2
+        client = ArelleValidationClient(self.url, None, retry_delay=0)
+        result = client.validate(self.filenames[0])
+        self.assertEqual(result.status, 200)
+        self.assertEqual(self.server.requests, 3)
+
+
+
 if __name__ == '__main__':
     unittest.main()
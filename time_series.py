@@ -0,0 +1,125 @@
+# Copyright 2018 kWh Analytics
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# pyou may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    # numpy is optional; without it values are kept as plain lists.
+    numpy = None
+
+
+FREQUENCIES = ["hourly", "daily", "monthly"]
+
+
+def _add_months(date, months):
+    month_index = date.month - 1 + months
+    year = date.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
+
+
+class TimeSeriesBlock(object):
+    """
+    A run of equally spaced duration facts for one concept in one
+    hypercube, e.g. the hourly MeasuredEnergy of one system for a year.
+    The values are stored as an array; contexts and Facts are only created
+    when the document is serialized.
+    """
+    def __init__(self, tableName, concept, start, frequency, values,
+                 units=None, extra_dimensions={}, decimals=2):
+        """
+        start is the beginning of the first period. If it is a
+        datetime.datetime, each period runs from its start to the next
+        period's start; if it is a datetime.date, each period runs from its
+        first day to its last day inclusive (the convention used by
+        MonthlyOperatingReport).
+        frequency is "hourly", "daily", "monthly" or a datetime.timedelta.
+        values is an array or sequence with one value per period; None
+        and NaN values (missing data) produce no fact.
+        """
+        if frequency not in FREQUENCIES and \
+                not isinstance(frequency, datetime.timedelta):
+            raise Exception("Unknown time series frequency {}".format(
+                frequency))
+        is_datetime = isinstance(start, datetime.datetime)
+        if not is_datetime and (frequency == "hourly" or (
+                isinstance(frequency, datetime.timedelta) and
+                frequency.seconds)):
+            raise Exception("Sub-daily time series need a datetime start")
+        self.tableName = tableName
+        self.concept = concept
+        self.start = start
+        self.frequency = frequency
+        if numpy is not None:
+            self.values = numpy.asarray(values)
+        else:
+            self.values = list(values)
+        self.units = units
+        self.extra_dimensions = extra_dimensions
+        self.decimals = decimals
+
+    def __len__(self):
+        return len(self.values)
+
+    def _step(self):
+        if self.frequency == "hourly":
+            return datetime.timedelta(hours=1)
+        if self.frequency == "daily":
+            return datetime.timedelta(days=1)
+        return self.frequency
+
+    def iter_starts(self):
+        """
+        Yields the start of each period, plus the start of the period
+        after the last one.
+        """
+        if self.frequency == "monthly":
+            for i in range(len(self) + 1):
+                yield _add_months(self.start, i)
+            return
+        step = self._step()
+        current = self.start
+        for i in range(len(self) + 1):
+            yield current
+            current = current + step
+
+    def periods(self):
+        """
+        Returns the list of (start, end) durations, one per value.
+        """
+        starts = list(self.iter_starts())
+        if isinstance(self.start, datetime.datetime):
+            return zip(starts[:-1], starts[1:])
+        one_day = datetime.timedelta(days=1)
+        return [(begin, end - one_day)
+                for begin, end in zip(starts[:-1], starts[1:])]
+
+    def shape(self):
+        """
+        Blocks with equal shapes have the same contexts, so serialization
+        can compute them once and share them between concepts.
+        """
+        return (self.tableName, self.start, self.frequency, len(self),
+                tuple(sorted(self.extra_dimensions.items())))
+
+    def value_list(self):
+        # Converting the whole array at once is much faster than pulling
+        # numpy scalars out one at a time.
+        if numpy is not None:
+            return self.values.tolist()
+        return self.values
@@ -0,0 +1,333 @@
+# Copyright 2018 kWh Analytics
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# pyou may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import httplib
+import os
+import os.path
+import re
+import shutil
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import Queue
+
+from lxml import etree
+
+
+# One line of the Arelle validation log, e.g.
+# "[ERROR] [xbrl.4.8.2:unitRef] Fact has no unit - test_output_report.xml 12"
+ValidationMessage = collections.namedtuple(
+    "ValidationMessage", ["level", "code", "message", "location"])
+
+# Arelle's default log format leaves out the level, so the client asks for
+# this one instead (the service's logFormat parameter):
+LOG_FORMAT = "[%(levelname)s] [%(messageCode)s] %(message)s - %(file)s"
+
+_LOG_LINE = re.compile(r"^\s*(?:\[(?P<level>[A-Z][A-Z-]*)\]\s*(?=\[))?"
+                       r"\[(?P<code>[^\]]*)\]\s*(?P<message>.*?)"
+                       r"(?:\s+-\s+(?P<location>\S+(?:\s+\d+)?))?\s*$",
+                       re.DOTALL)
+
+# Arelle's log levels, including its own for calculation inconsistencies
+# and formula assertions, as ValidationMessage levels:
+_LEVELS = {
+    "debug": "info",
+    "info": "info",
+    "assertion-satisfied": "info",
+    "warning": "warning",
+    "inconsistency": "warning",
+    "error": "error",
+    "assertion-not-satisfied": "error",
+    "critical": "error"
+}
+
+
+def _level_for_code(code):
+    # Best effort for logs without the level (e.g. the default log format):
+    # informational lines are tagged "info", a code with "warning" in it
+    # is a warning, and everything else is taken to be an error.
+    lowered = code.lower()
+    if lowered == "" or lowered.startswith("info"):
+        return "info"
+    if "warning" in lowered:
+        return "warning"
+    return "error"
+
+
+def _level(levelname, code):
+    if not levelname:
+        return _level_for_code(code)
+    return _LEVELS.get(levelname.lower(), "error")
+
+
+def parse_validation_table(body):
+    """
+    Parses the HTML table returned by the Arelle REST service. Returns a
+    tuple of (raw cell texts, list of ValidationMessage).
+    """
+    tree = etree.HTML(body)
+    if tree is None:
+        return [], []
+    rows = []
+    messages = []
+    header = None
+    for tr in tree.iter("tr"):
+        headings = [th.text or "" for th in tr.iter("th")]
+        if headings:
+            header = [h.strip().lower() for h in headings]
+            continue
+        cells = [(td.text or "").strip("\n") for td in tr.iter("td")]
+        if not cells:
+            continue
+        rows.extend(cells)
+        if header is not None and len(header) == len(cells) and \
+                "message" in header:
+            # Multi-column log (level/code/message columns):
+            record = dict(zip(header, cells))
+            code = record.get("code", "")
+            level = _level(record.get("level", ""), code)
+            messages.append(ValidationMessage(level, code,
+                                              record["message"],
+                                              record.get("file")))
+            continue
+        for cell in cells:
+            match = _LOG_LINE.match(cell)
+            if match is None:
+                messages.append(ValidationMessage("info", "", cell.strip(),
+                                                  None))
+            else:
+                code = match.group("code")
+                level = _level(match.group("level"), code)
+                messages.append(ValidationMessage(level, code,
+                                                  match.group("message"),
+                                                  match.group("location")))
+    return rows, messages
+
+
+class ValidationResult(object):
+    """
+    The outcome of validating one instance document.
+    """
+    def __init__(self, filename, status, table_rows, messages):
+        self.filename = filename
+        self.status = status
+        self.table_rows = table_rows
+        self.messages = messages
+
+    @property
+    def errors(self):
+        return [m for m in self.messages if m.level == "error"]
+
+    @property
+    def warnings(self):
+        return [m for m in self.messages if m.level == "warning"]
+
+    def is_valid(self):
+        return len(self.errors) == 0
+
+
+class ValidationError(Exception):
+    pass
+
+
+def _same_content(filename, other, chunk_size=1 << 20):
+    if os.path.getsize(filename) != os.path.getsize(other):
+        return False
+    with open(filename, "rb") as infile, open(other, "rb") as otherfile:
+        while True:
+            chunk = infile.read(chunk_size)
+            if chunk != otherfile.read(chunk_size):
+                return False
+            if not chunk:
+                return True
+
+
+class ArelleValidationClient(object):
+    """
+    Client for the Arelle validation REST service (see the
+    xbrl-validation-pipeline docker container). Keeps a pool of keep-alive
+    HTTP connections and can validate many documents concurrently.
+    """
+    def __init__(self, api_url, target_dir=None, max_connections=4,
+                 max_retries=2, retry_delay=0.5, timeout=120):
+        """
+        api_url is the validation endpoint up to and including the file
+        prefix, e.g. "http://localhost:8080/rest/xbrl/validation?file=/ixbrl/"
+        target_dir is the xbrl-validation-pipeline checkout; documents are
+        staged into its "ixbrl" directory before validation. If None, the
+        documents are assumed to already be visible to the server.
+        max_connections is both the size of the connection pool and the
+        number of validations in flight at once in validate_many().
+        """
+        parsed = urlparse.urlsplit(api_url)
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path_prefix = parsed.path
+        if parsed.query:
+            self.path_prefix += "?" + parsed.query
+        if target_dir is not None:
+            target_dir = os.path.join(os.path.expanduser(target_dir), "ixbrl")
+        self.target_dir = target_dir
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self._pool = Queue.LifoQueue()
+        self._pool_lock = threading.Lock()
+        self._opened = 0
+
+    def _stage(self, filename):
+        # Put the document where the container can see it. Hard-link when
+        # we can, and skip the copy if an identical file is already there.
+        # A copy is only trusted if its content matches: a document
+        # regenerated within the same second can have the same size and
+        # (whole-second) mtime.
+        if self.target_dir is None:
+            return
+        target = os.path.join(self.target_dir, os.path.basename(filename))
+        if os.path.exists(target):
+            if os.path.samefile(filename, target):
+                return
+            if _same_content(filename, target):
+                return
+            os.remove(target)
+        try:
+            os.link(filename, target)
+        except (OSError, AttributeError):
+            shutil.copy2(filename, target)
+
+    def _connect(self):
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._pool_lock:
+            if self._opened < self.max_connections:
+                self._opened += 1
+                return self._connect()
+        return self._pool.get()
+
+    def _release(self, conn):
+        self._pool.put(conn)
+
+    def _get(self, path):
+        # Returns (status, body). Retries on dropped connections and on
+        # 5xx responses, which Arelle gives while it is still starting up.
+        attempt = 0
+        while True:
+            conn = self._acquire()
+            try:
+                conn.request("GET", path,
+                             headers={"Connection": "keep-alive"})
+                response = conn.getresponse()
+                body = response.read()
+                status = response.status
+                if response.getheader("connection", "").lower() == "close":
+                    conn.close()
+            except (socket.error, httplib.HTTPException) as e:
+                # Drop the broken socket; the pooled object reconnects
+                # automatically on its next request.
+                conn.close()
+                self._release(conn)
+                if attempt >= self.max_retries:
+                    raise ValidationError(
+                        "Validation request {} failed: {}".format(path, e))
+            else:
+                self._release(conn)
+                if status < 500 or attempt >= self.max_retries:
+                    return status, body
+            attempt += 1
+            time.sleep(self.retry_delay * attempt)
+
+    def validate(self, filename):
+        """
+        Validates one XBRL instance document and returns a ValidationResult.
+        """
+        self._stage(filename)
+        path = self.path_prefix + urllib.quote(os.path.basename(filename)) + \
+            "&logFormat=" + urllib.quote(LOG_FORMAT)
+        status, body = self._get(path)
+        if status != 200:
+            raise ValidationError("Validation of {} returned HTTP {}".format(
+                filename, status))
+        table_rows, messages = parse_validation_table(body)
+        return ValidationResult(filename, status, table_rows, messages)
+
+    def validate_many(self, filenames):
+        """
+        Validates a batch of documents with up to max_connections requests
+        in flight. Returns a list of ValidationResult in the same order as
+        filenames. If any validation failed outright, raises the first
+        failure after the whole batch has been attempted.
+        Documents are staged and requested by file name, so the batch
+        can't have two documents with the same name in different
+        directories; that raises a ValidationError before anything is sent.
+        """
+        filenames = list(filenames)
+        if self.target_dir is not None:
+            staged = {}
+            for filename in filenames:
+                name = os.path.basename(filename)
+                other = staged.setdefault(name, filename)
+                if other != filename and \
+                        os.path.abspath(other) != os.path.abspath(filename):
+                    raise ValidationError(
+                        "{} and {} would both be staged as {}".format(
+                            other, filename, name))
+        results = [None] * len(filenames)
+        failures = []
+        work = Queue.Queue()
+        for index, filename in enumerate(filenames):
+            work.put((index, filename))
+
+        def worker():
+            while True:
+                try:
+                    index, filename = work.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = self.validate(filename)
+                except Exception as e:
+                    failures.append((index, e))
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(self.max_connections, len(filenames)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise min(failures)[1]
+        return results
+
+    def close(self):
+        """
+        Closes all pooled connections.
+        """
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Queue.Empty:
+                break
+        with self._pool_lock:
+            self._opened = 0
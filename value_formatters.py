@@ -0,0 +1,151 @@
+# Copyright 2018 kWh Analytics
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# pyou may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import datetime
+
+
+# decimals is the string for the fact's "decimals" attribute (None for
+# facts without units); format turns a fact value into its text.
+CompiledFormatter = collections.namedtuple("CompiledFormatter",
+                                           ["decimals", "format"])
+
+DATATYPES = ["decimal", "integer", "date", "boolean", "enum", "string"]
+
+
+def _format_date(value):
+    if isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    return value if isinstance(value, basestring) else str(value)
+
+
+def _format_boolean(value):
+    if isinstance(value, basestring):
+        return value.lower()
+    return "true" if value else "false"
+
+
+def _format_any(value):
+    # For concepts of unknown datatype: pick by the value's type.
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, bool):
+        return _format_boolean(value)
+    if isinstance(value, datetime.date):
+        return _format_date(value)
+    return str(value)
+
+
+def _make_decimal_formatter(decimals):
+    spec = ".%df" % decimals
+    def format_decimal(value):
+        try:
+            return format(value, spec)
+        except (TypeError, ValueError):
+            # e.g. a numeric string from a CSV: pass it through unchanged.
+            return _format_any(value)
+    return format_decimal
+
+
+def _format_integer(value):
+    try:
+        return "%d" % round(value)
+    except TypeError:
+        return _format_any(value)
+
+
+def _make_enum_formatter(concept, allowed):
+    if not allowed:
+        return _format_any
+    allowed = frozenset(allowed)
+    def format_enum(value):
+        if value not in allowed:
+            raise Exception("{} is not a valid value for {}".format(
+                value, concept))
+        return str(value)
+    return format_enum
+
+
+class FormatterRegistry(object):
+    """
+    Compiles and caches one formatting function per concept, chosen from
+    the concept's datatype (if declared) or else its unit, so that facts
+    don't have to work out how to format themselves every time.
+    """
+    def __init__(self, datatypes={}, enums={}):
+        """
+        datatypes maps concept names to one of DATATYPES. Concepts not
+        listed are treated as "integer" if their unit is "pure", "decimal"
+        if they have any other unit, and formatted by value type otherwise.
+        enums maps "enum" concept names to the list of allowed values.
+        """
+        for concept, datatype in datatypes.items():
+            if datatype not in DATATYPES:
+                raise Exception("Unknown datatype {} for {}".format(
+                    datatype, concept))
+        self.datatypes = datatypes
+        self.enums = enums
+        self._compiled = {}
+
+    def __getstate__(self):
+        # Compiled functions are closures, which can't be pickled; they are
+        # cheap to compile again.
+        state = self.__dict__.copy()
+        state["_compiled"] = {}
+        return state
+
+    def get_datatype(self, concept, units):
+        datatype = self.datatypes.get(concept)
+        if datatype is not None:
+            return datatype
+        if units == "pure":
+            return "integer"
+        if units is not None:
+            return "decimal"
+        return None
+
+    def compile(self, concept, units, decimals):
+        datatype = self.get_datatype(concept, units)
+        if datatype == "decimal":
+            function = _make_decimal_formatter(decimals)
+        elif datatype == "integer":
+            function = _format_integer
+            decimals = 0
+        elif datatype == "date":
+            function = _format_date
+        elif datatype == "boolean":
+            function = _format_boolean
+        elif datatype == "enum":
+            function = _make_enum_formatter(concept,
+                                            self.enums.get(concept, []))
+        else:
+            function = _format_any
+        if units is None:
+            return CompiledFormatter(None, function)
+        return CompiledFormatter(str(decimals), function)
+
+    def get(self, concept, units, decimals):
+        """
+        Returns the CompiledFormatter for facts of the given concept, unit
+        and decimals, compiling it on first use.
+        """
+        key = (concept, units, decimals)
+        formatter = self._compiled.get(key)
+        if formatter is None:
+            formatter = self.compile(concept, units, decimals)
+            self._compiled[key] = formatter
+        return formatter
+
+
+DEFAULT_FORMATTERS = FormatterRegistry()
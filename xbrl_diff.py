@@ -0,0 +1,336 @@
+# Copyright 2018 kWh Analytics
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# pyou may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import hashlib
+import struct
+import xml.etree.cElementTree as cElementTree
+
+from xbrl_generator import AbstractXBRLInstance
+
+
+XBRLI = "{http://www.xbrl.org/2003/instance}"
+XBRLDI = "{http://xbrl.org/2006/xbrldi}"
+
+# One fact that differs between two documents. old_value is None for added
+# facts and new_value is None for removed ones. period is "forever",
+# "instant:<date>" or "duration:<start>/<end>"; dimensions is a sorted
+# tuple of (dimension, member) pairs.
+FactDifference = collections.namedtuple(
+    "FactDifference", ["concept", "entity", "period", "dimensions",
+                       "old_value", "new_value"])
+
+
+class DiffResult(object):
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+
+    def is_empty(self):
+        return not (self.added or self.removed or self.changed)
+
+
+def _hash(text):
+    # 64 bits of MD5 as an int: a fraction of the memory of the text itself
+    # and collisions are vanishingly unlikely at millions of facts.
+    return struct.unpack("<q", hashlib.md5(text).digest()[:8])[0]
+
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+    return text
+
+
+def _signature_hash(signature):
+    # A context's (entity, period, dimensions) signature as a 64-bit hash.
+    entity, period, dimensions = signature
+    return _hash(_encode("\x00".join([entity, period] +
+                                     ["%s=%s" % d for d in dimensions])))
+
+
+class _CanonicalFact(object):
+    # A fact described independently of context and unit IDs. entity,
+    # period and dimensions are only filled in if the context table was
+    # kept; context_hash always is.
+    __slots__ = ["concept", "entity", "period", "dimensions", "context_id",
+                 "context_hash", "value", "unit"]
+
+    def key_hash(self):
+        return _hash(_encode("%s\x00%d" % (self.concept, self.context_hash)))
+
+    def value_hash(self):
+        return _hash(_encode("%s\x00%s" % (self.value, self.unit or "")))
+
+
+def _resolve(qname, prefixes):
+    # "solar:Foo" -> "{http://...}Foo", using the document's prefixes.
+    if qname is None:
+        return None
+    qname = qname.strip()
+    if ":" in qname:
+        prefix, local = qname.split(":", 1)
+        if prefix in prefixes:
+            return "{%s}%s" % (prefixes[prefix], local)
+    return qname
+
+
+def _canonical_context(elem, prefixes):
+    # Returns (entity, period, dimensions) for a context element.
+    entity = (elem.findtext(XBRLI + "entity/" + XBRLI + "identifier")
+              or "").strip()
+    period = elem.find(XBRLI + "period")
+    if period.find(XBRLI + "forever") is not None:
+        period_text = "forever"
+    elif period.find(XBRLI + "instant") is not None:
+        period_text = "instant:" + period.findtext(XBRLI + "instant").strip()
+    else:
+        period_text = "duration:%s/%s" % (
+            period.findtext(XBRLI + "startDate").strip(),
+            period.findtext(XBRLI + "endDate").strip())
+    dimensions = []
+    for member in elem.iter():
+        if member.tag == XBRLDI + "explicitMember":
+            dimensions.append((_resolve(member.get("dimension"), prefixes),
+                               _resolve(member.text, prefixes)))
+        elif member.tag == XBRLDI + "typedMember":
+            value = "".join(child.text or "" for child in member).strip()
+            dimensions.append((_resolve(member.get("dimension"), prefixes),
+                               value))
+    return entity, period_text, tuple(sorted(dimensions))
+
+
+def _iter_file_elements(filename):
+    # Streams the top-level elements of an XBRL-XML file, yielding
+    # ("context", id, signature), ("unit", id, measures) and
+    # ("fact", elem, None), and freeing each one once it has been read.
+    prefixes = {}
+    root = None
+    for event, elem in cElementTree.iterparse(filename,
+                                              events=("start", "end",
+                                                      "start-ns")):
+        if event == "start-ns":
+            prefixes[elem[0]] = elem[1]
+            continue
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+        if elem is root:
+            continue
+        # Nested elements belong to a context or unit still being parsed.
+        if elem.tag == XBRLI + "context":
+            yield "context", elem.get("id"), _canonical_context(elem,
+                                                                prefixes)
+            root.remove(elem)
+        elif elem.tag == XBRLI + "unit":
+            measures = sorted(_resolve(m.text, prefixes)
+                              for m in elem.iter(XBRLI + "measure"))
+            yield "unit", elem.get("id"), "*".join(measures)
+            root.remove(elem)
+        elif elem.get("contextRef") is not None:
+            yield "fact", elem, None
+            root.remove(elem)
+
+
+def _iter_file_facts(filename, keep_contexts):
+    # Keeps only the contexts and units, not the facts, in memory; and of
+    # the contexts only their hashes unless keep_contexts is True.
+    contexts = {}
+    units = {}
+    for kind, item, value in _iter_file_elements(filename):
+        if kind == "context":
+            contexts[item] = value if keep_contexts else \
+                _signature_hash(value)
+        elif kind == "unit":
+            units[item] = value
+        else:
+            fact = _CanonicalFact()
+            fact.concept = item.tag
+            fact.context_id = item.get("contextRef")
+            fact.value = (item.text or "").strip()
+            unit = item.get("unitRef")
+            fact.unit = units.get(unit, unit)
+            _set_context(fact, contexts[fact.context_id], keep_contexts)
+            yield fact
+
+
+def _file_contexts(filename, context_ids):
+    # Reads the signatures of the given contexts from an XBRL-XML file.
+    found = {}
+    for kind, item, value in _iter_file_elements(filename):
+        if kind == "context" and item in context_ids:
+            found[item] = value
+    return found
+
+
+def _set_context(fact, context, keep_contexts):
+    if keep_contexts:
+        fact.entity, fact.period, fact.dimensions = context
+        fact.context_hash = _signature_hash(context)
+    else:
+        fact.entity = fact.period = fact.dimensions = None
+        fact.context_hash = context
+
+
+def _instance_prefixes(instance):
+    prefixes = {}
+    for name, uri in instance.namespaces.items():
+        if name.startswith("xmlns:"):
+            prefixes[name[len("xmlns:"):]] = uri
+    return prefixes
+
+
+def _instance_context(context, prefixes):
+    elem = context.toXML()
+    # Contexts are generated without the default namespace:
+    for child in elem.iter():
+        if ":" not in child.tag:
+            child.tag = XBRLI + child.tag
+        elif child.tag.startswith("xbrldi:"):
+            child.tag = XBRLDI + child.tag[len("xbrldi:"):]
+    return _canonical_context(elem, prefixes)
+
+
+def _iter_instance_facts(instance, keep_contexts):
+    # Same as _iter_file_facts, for an instance that hasn't been exported.
+    prefixes = _instance_prefixes(instance)
+    contexts = {}
+    for fact in instance.iter_all_facts():
+        context = fact.context
+        signature = contexts.get(context.get_id())
+        if signature is None:
+            signature = _instance_context(context, prefixes)
+            if not keep_contexts:
+                signature = _signature_hash(signature)
+            contexts[context.get_id()] = signature
+        result = _CanonicalFact()
+        result.concept = _resolve(fact.qualify(fact.concept), prefixes)
+        result.context_id = context.get_id()
+        result.value = fact.getFormatter().format(fact.value)
+        result.unit = None
+        if fact.units is not None:
+            result.unit = _resolve("units:" + fact.units, prefixes)
+        _set_context(result, signature, keep_contexts)
+        yield result
+
+
+def _instance_contexts(instance, context_ids):
+    prefixes = _instance_prefixes(instance)
+    found = {}
+    for tableName in instance.hypercubes:
+        for context in instance.hypercubes[tableName].iter_contexts():
+            if context.get_id() in context_ids:
+                found[context.get_id()] = _instance_context(context,
+                                                            prefixes)
+    return found
+
+
+def _iter_facts(source, keep_contexts):
+    if isinstance(source, AbstractXBRLInstance):
+        return _iter_instance_facts(source, keep_contexts)
+    return _iter_file_facts(source, keep_contexts)
+
+
+def _contexts(source, context_ids):
+    if isinstance(source, AbstractXBRLInstance):
+        return _instance_contexts(source, context_ids)
+    return _file_contexts(source, context_ids)
+
+
+def iter_canonical_facts(source):
+    """
+    Yields the facts of source -- an AbstractXBRLInstance or the filename
+    of an XBRL-XML document -- described by concept, entity, period and
+    dimensions rather than by context ID. Keeps every context of the
+    document in memory; diff() doesn't.
+    """
+    return _iter_facts(source, True)
+
+
+def _difference(fact, contexts, old_value, new_value):
+    entity, period, dimensions = contexts[fact.context_id]
+    return FactDifference(fact.concept, entity, period, dimensions,
+                          old_value, new_value)
+
+
+def diff(old, new):
+    """
+    Compares two instance documents and returns a DiffResult listing the
+    added, removed and changed facts. Each of old and new is either an
+    AbstractXBRLInstance or the filename of an XBRL-XML document. Facts
+    are matched by concept, entity, period and dimensions regardless of
+    context IDs.
+
+    Runs in time linear in the number of facts. Files are streamed; what
+    is held in memory is a pair of 64-bit hashes per fact of the old
+    document, a 64-bit hash per context ID of the document being read, and
+    the differences themselves. The old document is read a second time to
+    recover the details of removed and changed facts, and each document
+    once more (contexts only) if it has differences to report. If a
+    document repeats a fact, the last value wins.
+    """
+    old_hashes = {}
+    for fact in _iter_facts(old, False):
+        old_hashes[fact.key_hash()] = fact.value_hash()
+
+    result = DiffResult()
+    # Keys matched so far with their old value hash, and the last added
+    # or changed occurrence of each key, so that a repeated fact in the
+    # new document is compared by its last value:
+    matched = {}
+    added = collections.OrderedDict()
+    changed = collections.OrderedDict()
+    for fact in _iter_facts(new, False):
+        key = fact.key_hash()
+        if key in added:
+            added[key] = fact
+            continue
+        old_value = matched.get(key)
+        if old_value is None:
+            old_value = old_hashes.pop(key, None)
+            if old_value is None:
+                added[key] = fact
+                continue
+            matched[key] = old_value
+        if old_value != fact.value_hash():
+            changed[key] = fact
+        else:
+            changed.pop(key, None)
+    if added:
+        contexts = _contexts(new, set(fact.context_id
+                                      for fact in added.values()))
+        result.added = [_difference(fact, contexts, None, fact.value)
+                        for fact in added.values()]
+
+    # Whatever is left in old_hashes was removed:
+    if changed or old_hashes:
+        found = collections.OrderedDict()
+        for fact in _iter_facts(old, False):
+            key = fact.key_hash()
+            if key in changed:
+                found[key] = (fact, changed[key].value)
+            elif key in old_hashes:
+                found[key] = (fact, None)
+        contexts = _contexts(old, set(fact.context_id for fact, new_value
+                                      in found.values()))
+        for fact, new_value in found.values():
+            if new_value is None:
+                result.removed.append(_difference(fact, contexts,
+                                                  fact.value, None))
+            else:
+                result.changed.append(_difference(fact, contexts,
+                                                  fact.value, new_value))
+    return result
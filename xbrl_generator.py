@@ -14,8 +14,63 @@
 
 import xml.etree.ElementTree
 from xml.etree.ElementTree import Element, SubElement
+import collections
 import datetime
+import itertools
 import json
+import StringIO
+import threading
+from xml.sax.saxutils import quoteattr
+
+from value_formatters import FormatterRegistry, DEFAULT_FORMATTERS
+from time_series import TimeSeriesBlock
+from rollup import RollUp, RollUpAccumulator
+
+
+def _escape_text(text):
+    # As ElementTree escapes element text.
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def _escape_attrib(text):
+    # As ElementTree escapes attribute values.
+    text = _escape_text(text)
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    return text
+
+
+def format_period_date(value):
+    """
+    Formats a period start, end or instant: dates as YYYY-MM-DD, and
+    datetimes (for sub-daily periods) as YYYY-MM-DDThh:mm:ss.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%S")
+    return value.strftime("%Y-%m-%d")
+
+
+def context_key(duration=None, instant=None, extra_dimensions={}):
+    """
+    Returns a hashable key that identifies a context within a hypercube:
+    two calls with equal period and dimension values return equal keys.
+    """
+    if duration is not None and duration != "forever":
+        period = ("duration", duration[0], duration[1])
+    elif instant is not None:
+        period = ("instant", instant)
+    else:
+        period = ("forever",)
+    return (period, tuple(sorted(extra_dimensions.items())))
+
 
 class Context(object):
     """
@@ -74,6 +129,13 @@ class Context(object):
                 return False
         return True
 
+    def get_key(self):
+        """
+        Returns the hashable key for my period and dimensions, see
+        context_key().
+        """
+        return context_key(self.duration, self.instant, self.extra_dimensions)
+
     def set_id(self, new_id):
         self._id = new_id
 
@@ -103,12 +165,12 @@ class Context(object):
             forever = SubElement(period, "forever")
         elif self.duration is not None:
             startDate = SubElement(period, "startDate")
-            startDate.text = self.duration[0].strftime("%Y-%m-%d")
+            startDate.text = format_period_date(self.duration[0])
             endDate = SubElement(period, "endDate")
-            endDate.text = self.duration[1].strftime("%Y-%m-%d")
+            endDate.text = format_period_date(self.duration[1])
         elif self.instant is not None:
             instant_elem = SubElement(period, "instant")
-            instant_elem.text = self.instant.strftime("%Y-%m-%d")
+            instant_elem.text = format_period_date(self.instant)
 
 
         # Extra dimensions:
@@ -145,10 +207,10 @@ class Context(object):
         if self.duration == "forever":
             aspects["xbrl:period"] = "forever" # TODO is this right syntax???
         elif self.duration is not None:
-            aspects["xbrl:periodStart"] = self.duration[0].strftime("%Y-%m-%d")
-            aspects["xbrl:periodEnd"] = self.duration[1].strftime("%Y-%m-%d")
+            aspects["xbrl:periodStart"] = format_period_date(self.duration[0])
+            aspects["xbrl:periodEnd"] = format_period_date(self.duration[1])
         elif self.instant is not None:
-            aspects["xbrl:instant"] = self.instant.strftime("%Y-%m-%d")
+            aspects["xbrl:instant"] = format_period_date(self.instant)
             # TODO is this the right syntax???
 
         for dimension in self.extra_dimensions.keys():
@@ -170,33 +232,106 @@ class Hypercube(object):
     Will internally generate and save the contexts needed for the facts.
     Can turn itself into a list of XML Context tags for export.
     """
-    def __init__(self, namespace, tableName, entity, typedDimensionDomains):
+    def __init__(self, namespace, tableName, entity, typedDimensionDomains,
+                 store=None, formatters=DEFAULT_FORMATTERS):
         # typedDimensionDomains is a dictionary mapping dimension names
         # to domain names for every dimension that is typed.
+        # store is an optional disk-backed context store (see
+        # context_store.py); if None, contexts are kept in memory.
+        # formatters is the FormatterRegistry used by facts in this cube.
         self.namespace = namespace
         self.tableName = tableName
         self.entity = entity
         self.contexts = []
         self.typedDimensionDomains = typedDimensionDomains
+        self.store = store
+        self.formatters = formatters
+        # Maps context_key() to Context so lookups don't scan every context:
+        self._index = {}
+        self._count = 0
+        # Whether any of my contexts has extra dimensions (and so needs the
+        # xbrldi namespace); assume so for contexts already in a store.
+        self.has_dimensions = False
+        # Each hypercube has its own lock, so producers adding to different
+        # tables don't contend with each other.
+        self._lock = threading.Lock()
+        if store is not None:
+            self._count = store.count_contexts(tableName)
+            self.has_dimensions = self._count > 0
 
     def get_context(self, duration=None, instant=None, extra_dimensions={}):
         # If we already made a context for this, return its ID.
         # Otherwise, create a context, store it, and return new context ID.
-        for context in self.contexts:
-            # It's not strictly necessary to compare entities right now because
-            # all contexts in the same cube will necessarily have the same
-            # entity, however in the future this may not be true(?)
-            if context.is_equal(self.entity, duration, instant, extra_dimensions):
+        # It's not strictly necessary to include the entity in the key right
+        # now because all contexts in the same cube will necessarily have the
+        # same entity, however in the future this may not be true(?)
+        key = context_key(duration, instant, extra_dimensions)
+        return self._get_context_by_key(key, duration, instant,
+                                        extra_dimensions)
+
+    def get_duration_contexts(self, durations, extra_dimensions={}):
+        """
+        Returns a list with the context for each (start, end) duration in
+        durations, all sharing the same extra dimensions. Much cheaper than
+        calling get_context() for each one.
+        """
+        dimensions = tuple(sorted(extra_dimensions.items()))
+        return [self._get_context_by_key((("duration", start, end), dimensions),
+                                         (start, end), None, extra_dimensions)
+                for start, end in durations]
+
+    def _get_context_by_key(self, key, duration, instant, extra_dimensions):
+        # Existing contexts can be found without locking, because a dict
+        # lookup is atomic; only creating a context takes my lock.
+        if self.store is None:
+            context = self._index.get(key)
+            if context is not None:
                 return context
+        with self._lock:
+            return self._find_or_create(key, duration, instant,
+                                        extra_dimensions)
+
+    def _find_or_create(self, key, duration, instant, extra_dimensions):
+        # Called with my lock held.
+        if self.store is not None:
+            context = self.store.get_context(self, key)
+        else:
+            context = self._index.get(key)
+        if context is not None:
+            return context
         new_context = Context(self, self.entity, duration, instant, extra_dimensions)
         # For the ID, just use "HypercubeName_serialNumber":
-        new_id = "%s_%d" % (self.tableName, len(self.contexts))
+        new_id = "%s_%d" % (self.tableName, self._count)
         new_context.set_id(new_id)
-        self.contexts.append(new_context)
+        self._count += 1
+        if extra_dimensions:
+            self.has_dimensions = True
+        if self.store is not None:
+            self.store.add_context(self, key, new_context)
+        else:
+            self._index[key] = new_context
+            self.contexts.append(new_context)
         return new_context
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def iter_contexts(self):
+        """
+        Yields my contexts in the order their IDs were assigned.
+        """
+        if self.store is not None:
+            return self.store.iter_contexts(self)
+        return iter(self.contexts)
+
     def toXML(self):
-        return [context.toXML() for context in self.contexts]
+        return [context.toXML() for context in self.iter_contexts()]
 
     def getNamespace(self):
         return self.namespace
@@ -218,9 +353,9 @@ class Fact(object):
         Concept is the field name - it must match the schema definition.
         Context is a reference to this fact's parent Context object.
         Units is a string naming the unit, for example "kWh"
-        Value is a string, integer, or float
-        Decimals is used only for float types, it is the number of
-        digits 
+        Value is a string, integer, float, date or boolean
+        Decimals is used only for decimal types, it is the number of
+        digits after the decimal point that the value is rounded to.
         """
         # in case of xml the context ID will be rendered in the fact tag.
         # in case of json the contexts' attributes will be copied to the
@@ -230,6 +365,7 @@ class Fact(object):
         self.context = context
         self.units = units
         self.decimals = decimals
+        self._formatter = None
 
     def qualify(self, string):
         """
@@ -237,24 +373,51 @@ class Fact(object):
         """
         return self.context.qualify(string)
 
+    def getFormatter(self):
+        """
+        Returns the compiled formatter for my concept, unit and decimals
+        from my hypercube's FormatterRegistry.
+        """
+        if self._formatter is None:
+            self._formatter = self.context.hypercube.formatters.get(
+                self.concept, self.units, self.decimals)
+        return self._formatter
+
     def toXML(self):
         """
         Return the Fact as an XML element.
         """
+        formatter = self.getFormatter()
         attribs = {"contextRef": self.context.get_id()}
         if self.units is not None:
             attribs["unitRef"] = self.units
-            if self.units == "pure" or self.units == "degrees":
-                attribs["decimals"] = "0"
-            else:
-                attribs["decimals"] = str(self.decimals)
+            attribs["decimals"] = formatter.decimals
         elem = Element(self.qualify(self.concept), attrib=attribs)
-        if self.units == "pure":
-            elem.text = "%d" % self.value
-        else:
-            elem.text = str(self.value)
+        elem.text = formatter.format(self.value)
         return elem
 
+    def toXMLString(self):
+        """
+        Return the Fact serialized as XML; the same as passing toXML() to
+        ElementTree.tostring(), but without building the element.
+        """
+        formatter = self.getFormatter()
+        tag = self.qualify(self.concept)
+        # Attributes in the sorted order ElementTree writes them in:
+        parts = ["<", tag, ' contextRef="', _escape_attrib(self.context.get_id())]
+        if self.units is not None:
+            parts.extend(['" decimals="', _escape_attrib(formatter.decimals),
+                          '" unitRef="', _escape_attrib(self.units)])
+        text = formatter.format(self.value)
+        if text:
+            parts.extend(['">', _escape_text(text), "</", tag, ">"])
+        else:
+            parts.append('" />')
+        result = "".join(parts)
+        if isinstance(result, unicode):
+            result = result.encode("us-ascii", "xmlcharrefreplace")
+        return result
+
 
     def toJSON(self):
         """
@@ -265,12 +428,257 @@ class Fact(object):
         if self.units is not None:
             aspects["xbrl:unit"] = self.units
 
-        if isinstance( self.value, datetime.datetime):
-            value_str = self.value.strftime("%Y-%m-%d")
-        else:
-            value_str = str(self.value)
         return { "aspects": aspects,
-                 "value": value_str}
+                 "value": self.getFormatter().format(self.value)}
+
+
+def to_base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        result = digits[remainder] + result
+        if number == 0:
+            return result
+
+
+class CompactionReport(object):
+    """
+    Result of a compact export: how many bytes were written and how many
+    the same document would have taken with the default profile.
+    """
+    def __init__(self, bytes_written, bytes_saved):
+        self.bytes_written = bytes_written
+        self.bytes_saved = bytes_saved
+
+    @property
+    def baseline_bytes(self):
+        return self.bytes_written + self.bytes_saved
+
+    def __str__(self):
+        return "%d bytes written, %d bytes (%.1f%%) saved" % (
+            self.bytes_written, self.bytes_saved,
+            100.0 * self.bytes_saved / max(self.baseline_bytes, 1))
+
+
+class XMLCompactor(object):
+    """
+    The compact XML serialization profile: rewrites context IDs to short
+    base-36 IDs, sorts each context's dimensions so output is
+    deterministic, and keeps only the namespace declarations the document
+    uses. Counts the bytes saved as it goes.
+    """
+    def __init__(self, instance):
+        self.instance = instance
+        self.offsets = None
+        self.bytes_saved = 0
+
+    def short_id(self, context_id):
+        if self.offsets is None:
+            # Once the facts are generated, give each table a contiguous
+            # range of short IDs, in table name order, so that a context's
+            # short ID follows from its long one.
+            self.offsets = {}
+            total = 0
+            for tableName in sorted(self.instance.hypercubes.keys()):
+                self.offsets[tableName] = total
+                total += self.instance.hypercubes[tableName]._count
+        tableName, serial = context_id.rsplit("_", 1)
+        return "c" + to_base36(self.offsets[tableName] + int(serial))
+
+    def namespaces(self, units):
+        """
+        Returns the namespace declarations the document actually uses.
+        Call after the facts are generated.
+        """
+        instance = self.instance
+        used = ["xmlns", "xmlns:link", "xmlns:xlink"]
+        if units:
+            used.append("xmlns:units")
+        for cube in instance.hypercubes.values():
+            if cube._count > 0:
+                used.append("xmlns:" + cube.getNamespace())
+            if cube.has_dimensions:
+                used.append("xmlns:xbrldi")
+        kept = {}
+        for name, value in instance.namespaces.items():
+            if name in used:
+                kept[name] = value
+            else:
+                self.bytes_saved += len(' %s=%s' % (name, quoteattr(value)))
+        return kept
+
+    def context(self, elem):
+        long_id = elem.get("id")
+        short_id = self.short_id(long_id)
+        elem.set("id", short_id)
+        self.bytes_saved += len(long_id) - len(short_id)
+        segment = elem.find("entity/segment")
+        if segment is not None:
+            segment[:] = sorted(segment, key=lambda e: e.get("dimension"))
+        return elem
+
+    def fact(self, elem):
+        long_id = elem.get("contextRef")
+        short_id = self.short_id(long_id)
+        elem.set("contextRef", short_id)
+        self.bytes_saved += len(long_id) - len(short_id)
+        return elem
+
+
+class SharedFragments(object):
+    """
+    Serialized pieces of the document that more than one writer in an
+    export needs, computed once: each context's XML and JSON aspects, and
+    the XML of the fact currently being written.
+    """
+    def __init__(self, cache_size=10000):
+        self.cache_size = cache_size
+        self._context_xml = {}
+        self._context_json = collections.OrderedDict()
+        self._fact = None
+        self._fact_xml = None
+
+    def context_xml(self, context):
+        # Every context is written once per XML writer, in order, so only
+        # the current one needs keeping.
+        cached = self._context_xml.get(context.get_id())
+        if cached is None:
+            cached = xml.etree.ElementTree.tostring(context.toXML())
+            self._context_xml = {context.get_id(): cached}
+        return cached
+
+    def context_json(self, context):
+        """
+        Returns the JSON of the context's aspects without the closing brace,
+        so that the fact's own aspects can be appended.
+        """
+        context_id = context.get_id()
+        cached = self._context_json.pop(context_id, None)
+        if cached is None:
+            cached = json.dumps(context.toJSON())[:-1]
+            if len(self._context_json) >= self.cache_size:
+                self._context_json.popitem(last=False)
+        self._context_json[context_id] = cached
+        return cached
+
+    def fact_xml(self, fact):
+        if fact is not self._fact:
+            self._fact = fact
+            self._fact_xml = fact.toXMLString()
+        return self._fact_xml
+
+
+class _CountingFile(object):
+    # Wraps an output file and counts the bytes written to it.
+    def __init__(self, target):
+        self.owned = isinstance(target, basestring)
+        self.outfile = open(target, "wb") if self.owned else target
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.outfile.write(data)
+
+    def close(self):
+        if self.owned:
+            self.outfile.close()
+
+
+class XMLWriter(object):
+    """
+    Export target writing XBRL-XML to a filename or file-like object. See
+    AbstractXBRLInstance.export(). If compact is True, uses the compact
+    serialization profile and sets report to a CompactionReport at the end.
+    """
+    def __init__(self, target, compact=False):
+        self.target = target
+        self.compact = compact
+        self.compactor = None
+        self.report = None
+
+    def begin(self, instance, units):
+        self.outfile = _CountingFile(self.target)
+        namespaces = instance.namespaces
+        if self.compact:
+            self.compactor = XMLCompactor(instance)
+            namespaces = self.compactor.namespaces(units)
+        tostring = xml.etree.ElementTree.tostring
+        # Serialize an empty root and split it open around the children:
+        root = tostring(Element("xbrl", attrib = namespaces))
+        self.outfile.write(root[:-2].rstrip() + ">")
+        self.outfile.write(tostring(Element(
+            "link:schemaRef", attrib = {"xlink:href": instance.taxonomy,
+                                        "xlink:type": "simple"})))
+        self.makeUnitTag = instance.makeUnitTag
+
+    def context(self, context, fragments):
+        if self.compactor is None:
+            self.outfile.write(fragments.context_xml(context))
+        else:
+            self.outfile.write(xml.etree.ElementTree.tostring(
+                self.compactor.context(context.toXML())))
+
+    def units(self, units):
+        for unit in units:
+            self.outfile.write(xml.etree.ElementTree.tostring(
+                self.makeUnitTag(unit)))
+
+    def fact(self, fact, fragments):
+        if self.compactor is None:
+            self.outfile.write(fragments.fact_xml(fact))
+        else:
+            self.outfile.write(xml.etree.ElementTree.tostring(
+                self.compactor.fact(fact.toXML())))
+
+    def end(self):
+        self.outfile.write("</xbrl>")
+        self.outfile.close()
+        if self.compactor is not None:
+            self.report = CompactionReport(self.outfile.bytes_written,
+                                           self.compactor.bytes_saved)
+
+
+class JSONWriter(object):
+    """
+    Export target writing xBRL-JSON to a filename or file-like object. See
+    AbstractXBRLInstance.export().
+    """
+    def __init__(self, target):
+        self.target = target
+
+    def begin(self, instance, units):
+        self.outfile = _CountingFile(self.target)
+        header = json.dumps(instance._jsonHeader())
+        # The empty facts list serializes as "[]"; split the document there.
+        before, self.after = header.split('"facts": []', 1)
+        self.outfile.write(before + '"facts": [')
+        self.first = True
+
+    def context(self, context, fragments):
+        pass
+
+    def units(self, units):
+        pass
+
+    def fact(self, fact, fragments):
+        # Same structure as Fact.toJSON(), built from the shared context
+        # aspects instead of re-serializing them for every fact.
+        parts = [fragments.context_json(fact.context),
+                 ', "xbrl:concept": ', json.dumps(fact.qualify(fact.concept))]
+        if fact.units is not None:
+            parts.extend([', "xbrl:unit": ', json.dumps(fact.units)])
+        parts.extend(['}, "value": ',
+                      json.dumps(fact.getFormatter().format(fact.value)),
+                      '}'])
+        if not self.first:
+            self.outfile.write(", ")
+        self.first = False
+        self.outfile.write('{"aspects": ' + "".join(parts))
+
+    def end(self):
+        self.outfile.write("]" + self.after)
+        self.outfile.close()
 
 
 class AbstractXBRLInstance(object):
@@ -279,7 +687,8 @@ class AbstractXBRLInstance(object):
     instance document for a specific reporting purpose. Can export itself
     as either XML or JSON.
     """
-    def __init__(self, taxonomy, extra_ns={}, entity_name = "Unspecified"):
+    def __init__(self, taxonomy, extra_ns={}, entity_name = "Unspecified",
+                 context_store=None):
 
         # Note that these namespace URLs do not necessarily resolve to
         # documents -- they may give 404s if you try to load them. They
@@ -305,6 +714,38 @@ class AbstractXBRLInstance(object):
         self.hypercubes = {} # key will be table name, value will be
         # instance of Hypercube class
 
+        # Optional disk-backed store for contexts and facts (see
+        # context_store.py), for documents too large to build in memory:
+        self.context_store = context_store
+
+        # Compiled per-concept value formatters, shared by all hypercubes:
+        self.formatters = FormatterRegistry(self.getConceptDatatypes(),
+                                            self.getConceptEnums())
+
+        # TimeSeriesBlocks added with addTimeSeries():
+        self.time_series = []
+
+        # RollUps added with addRollUp():
+        self.rollups = []
+
+        # Guards creation of hypercubes, so that several producer threads
+        # can add data to one instance at the same time:
+        self._lock = threading.Lock()
+
+        # How far ingestion has got, e.g. rows read per CursorIngest source;
+        # saved with checkpoints so that a resumed build can skip ahead.
+        self.progress = {}
+
+    def __getstate__(self):
+        # Locks can't be pickled (see checkpoint.py); make a new one on load.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
     def getContext(self, tableName, duration=None, instant=None,
                      extra_dimensions={}):
         """
@@ -312,17 +753,61 @@ class AbstractXBRLInstance(object):
         part of the given table. Creates the context if it doesn't exist
         yet.
         """
-        # Find the hypercube matching the table name, or create one if it
-        # doesn't exist yet:
-        if tableName in self.hypercubes:
-            cube = self.hypercubes[tableName]
-        else:
+        cube = self.getHypercube(tableName)
+        # ask the matching hypercube for the right context:
+        return cube.get_context(duration, instant, extra_dimensions)
+
+    def getHypercube(self, tableName):
+        """
+        Returns the Hypercube for the given table, creating it if it
+        doesn't exist yet.
+        """
+        cube = self.hypercubes.get(tableName)
+        if cube is not None:
+            return cube
+        with self._lock:
+            # Check again: another thread may have created it meanwhile.
+            if tableName in self.hypercubes:
+                return self.hypercubes[tableName]
             domainMap = self.getTypedDimensionDomains()
             ns = self.getNamespacePrefix()
-            cube = Hypercube(ns, tableName, self.entity_name, domainMap)
+            cube = Hypercube(ns, tableName, self.entity_name, domainMap,
+                             self.context_store, self.formatters)
             self.hypercubes[tableName] = cube
-        # ask the matching hypercube for the right context:
-        return cube.get_context(duration, instant, extra_dimensions)
+        return cube
+
+    def addTimeSeries(self, tableName, concept, start, frequency, values,
+                      units=None, extra_dimensions={}, decimals=2):
+        """
+        Adds one duration fact per value, for consecutive periods of the
+        given frequency ("hourly", "daily", "monthly" or a timedelta)
+        starting at start. The values are kept as an array and only turned
+        into contexts and facts on export; see TimeSeriesBlock.
+        """
+        block = TimeSeriesBlock(tableName, concept, start, frequency, values,
+                                units, extra_dimensions, decimals)
+        self.time_series.append(block)
+        return block
+
+    def addRollUp(self, concept, tableName=None, aggregate="sum",
+                  drop_dimensions=["PVSystemIdentifierAxis"], regroup=None,
+                  target_table=None, target_concept=None):
+        """
+        Adds aggregate facts of the given concept, e.g. the total over all
+        systems per period: facts are grouped by table, period and their
+        dimensions other than drop_dimensions, and each group's aggregate
+        ("sum", "mean", "min" or "max") is added in a context without the
+        dropped dimensions. Computed on export; see RollUp. Adding the
+        same roll-up twice raises an exception, as does a source fact that
+        is already in its roll-up context (it would be duplicated).
+        """
+        rollup = RollUp(concept, tableName, aggregate, drop_dimensions,
+                        regroup, target_table, target_concept)
+        if rollup in self.rollups:
+            raise Exception("Roll-up of {} into {} was already added".format(
+                concept, rollup.target_concept))
+        self.rollups.append(rollup)
+        return rollup
 
     def makeUnitTag(self, unit_id):
         """
@@ -345,6 +830,22 @@ class AbstractXBRLInstance(object):
         """
         return {}
 
+    def getConceptDatatypes(self):
+        """
+        Return a dictionary mapping concept names to datatypes (see
+        value_formatters.DATATYPES) for concepts whose datatype can't be
+        told from their unit. Override me in a subclass.
+        """
+        return {}
+
+    def getConceptEnums(self):
+        """
+        Return a dictionary mapping each "enum" concept (see
+        getConceptDatatypes) to the list of its allowed values; values
+        outside the list are rejected on export. Override me in a subclass.
+        """
+        return {}
+
     def get_required_units(self):
         """
         Return a list of unit names required by the instance
@@ -359,7 +860,128 @@ class AbstractXBRLInstance(object):
         """
         return []
 
+    def iter_facts(self):
+        """
+        Return an iterator over the facts. Defaults to get_facts(); override
+        me with a generator so that large documents can be streamed into a
+        context store without holding every Fact in memory.
+        """
+        return iter(self.get_facts())
+
+    def _time_series_contexts(self):
+        # Creates the contexts of every time series block, returning them
+        # by block shape: blocks with the same table, periods and
+        # dimensions share one list of contexts.
+        shared_contexts = {}
+        for block in self.time_series:
+            shape = block.shape()
+            if shape not in shared_contexts:
+                cube = self.getHypercube(block.tableName)
+                shared_contexts[shape] = cube.get_duration_contexts(
+                    block.periods(), block.extra_dimensions)
+        return shared_contexts
+
+    def iter_time_series_facts(self, shared_contexts=None):
+        """
+        Yields the facts of every time series block. shared_contexts is
+        what _time_series_contexts() returns, if already called.
+        """
+        if shared_contexts is None:
+            shared_contexts = self._time_series_contexts()
+        for block in self.time_series:
+            contexts = shared_contexts[block.shape()]
+            for context, value in zip(contexts, block.value_list()):
+                if value is None or value != value: # NaN: no data
+                    continue
+                yield Fact(block.concept, context, block.units, value,
+                           block.decimals)
+
+    def _rollup_results(self, accumulator):
+        # Adds the time series blocks to the accumulator as whole arrays,
+        # and returns (concept, context, units, decimals, value) for each
+        # roll-up fact, creating the contexts.
+        for block in self.time_series:
+            accumulator.add_block(block)
+        results = []
+        for rollup, tableName, period, dimensions, units, decimals, value \
+                in accumulator.results():
+            duration = instant = None
+            if period[0] == "duration":
+                duration = (period[1], period[2])
+            elif period[0] == "instant":
+                instant = period[1]
+            context = self.getContext(tableName, duration, instant,
+                                      dict(dimensions))
+            results.append((rollup.target_concept, context, units, decimals,
+                            value))
+        return results
+
+    def iter_rollup_facts(self, accumulator, results=None):
+        """
+        Yields the roll-up facts, given a RollUpAccumulator that has been
+        fed the facts of iter_facts(). results is what _rollup_results()
+        returns, if already called.
+        """
+        if results is None:
+            results = self._rollup_results(accumulator)
+        for concept, context, units, decimals, value in results:
+            yield Fact(concept, context, units, value, decimals)
+
+    def iter_all_facts(self):
+        """
+        Yields every fact of the document: iter_facts(), the time series
+        facts, and then the roll-up facts.
+        """
+        accumulator = None
+        if self.rollups:
+            accumulator = RollUpAccumulator(self.rollups)
+        for fact in self.iter_facts():
+            if accumulator is not None:
+                accumulator.add_fact(fact)
+            yield fact
+        for fact in self.iter_time_series_facts():
+            yield fact
+        if accumulator is not None:
+            for fact in self.iter_rollup_facts(accumulator):
+                yield fact
+
+    def _iter_export_facts(self):
+        # Like iter_all_facts(), but creates every context up front, so
+        # that the contexts can be written before the facts, while holding
+        # only the facts of iter_facts() in memory: time series and roll-up
+        # facts are only created as they are written.
+        accumulator = None
+        if self.rollups:
+            accumulator = RollUpAccumulator(self.rollups)
+        facts = []
+        for fact in self.iter_facts():
+            if accumulator is not None:
+                accumulator.add_fact(fact)
+            facts.append(fact)
+        shared_contexts = self._time_series_contexts()
+        rollup_facts = []
+        if accumulator is not None:
+            rollup_facts = self.iter_rollup_facts(
+                accumulator, self._rollup_results(accumulator))
+        return itertools.chain(
+            facts, self.iter_time_series_facts(shared_contexts), rollup_facts)
+
+    def get_all_required_units(self):
+        """
+        Returns get_required_units() plus any units used by time series.
+        Call after the facts have been generated.
+        """
+        units = list(self.get_required_units())
+        for block in self.time_series:
+            if block.units is not None and block.units not in units:
+                units.append(block.units)
+        return units
+
     def toXMLTag(self):
+        """
+        Builds the whole document as an XML element, in the same order as
+        export() writes it.
+        """
         # The root element:
         xbrl = Element("xbrl", attrib = self.namespaces)
 
@@ -371,55 +993,91 @@ class AbstractXBRLInstance(object):
         # Generate facts first (even though they'll go last in the document)
         # because creating the facts will create the needed contexts as a
         # side-effect.
-        facts = self.get_facts()
+        facts = list(self.iter_all_facts())
 
         # Add a context tag for each context we want to reference:
-        for hypercube in self.hypercubes.values():
-            tags = hypercube.toXML()
-            for tag in tags:
+        for tableName in sorted(self.hypercubes.keys()):
+            for tag in self.hypercubes[tableName].toXML():
                 xbrl.append(tag)
 
-        for unit in self.get_required_units():
+        for unit in self.get_all_required_units():
             # Add a unit tag defining each unit we want to reference:
             xbrl.append(self.makeUnitTag(unit))
 
-        for fact in self.get_facts():
+        for fact in facts:
             xbrl.append( fact.toXML() )
 
         return xbrl
 
-    def toXML(self, filename):
+    def spillFacts(self):
         """
-        Exports XBRL as XML to the given filename.
+        Generates every fact and writes it to the context store, so that
+        export can stream contexts and facts back from disk. Only valid
+        if this instance has a context store.
         """
-        xbrl = self.toXMLTag()
-        tree = xml.etree.ElementTree.ElementTree(xbrl)
-        # Apparently every XML file should start with this, which ElementTree
-        # doesn't do:
-        # <?xml version="1.0" encoding="utf-8"?>
-        tree.write(filename)
+        self.context_store.clear_facts()
+        for fact in self.iter_all_facts():
+            self.context_store.add_fact(fact)
+        self.context_store.flush()
 
-    def toXMLString(self):
+    def export(self, writers):
         """
-        Returns XBRL as an XML string
+        Exports the document to several outputs at once, e.g.
+        export([XMLWriter("report.xml"), JSONWriter("report.json")]).
+        The facts are generated and the contexts and facts traversed only
+        once; the writers share each context's serialized fragments.
         """
-        xbrl = self.toXMLTag()
-        return xml.etree.ElementTree.tostring(xbrl).decode()
+        # Generate facts first because creating the facts will create the
+        # needed contexts as a side-effect.
+        if self.context_store is not None:
+            self.spillFacts()
+            facts = self.context_store.iter_facts(self.hypercubes)
+        else:
+            facts = self._iter_export_facts()
+        units = self.get_all_required_units()
+        fragments = SharedFragments()
+
+        for writer in writers:
+            writer.begin(self, units)
+        for tableName in sorted(self.hypercubes.keys()):
+            for context in self.hypercubes[tableName].iter_contexts():
+                for writer in writers:
+                    writer.context(context, fragments)
+        for writer in writers:
+            writer.units(units)
+        for fact in facts:
+            for writer in writers:
+                writer.fact(fact, fragments)
+        for writer in writers:
+            writer.end()
 
+    def toXML(self, filename, compact=False):
+        """
+        Exports XBRL as XML to the given filename. If compact is True, uses
+        the compact serialization profile (see XMLCompactor) and returns a
+        CompactionReport.
+        """
+        writer = XMLWriter(filename, compact)
+        self.export([writer])
+        return writer.report
 
-    def toJSON(self, filename):
+    def toXMLString(self, compact=False):
         """
-        Exports XBRL as JSON to the given filename.
+        Returns XBRL as an XML string. If compact is True, uses the compact
+        serialization profile (see XMLCompactor).
         """
+        buf = StringIO.StringIO()
+        self.export([XMLWriter(buf, compact)])
+        return buf.getvalue()
 
-        outfile = open(filename, "w")
-        outfile.write(self.toJSONString())
-        outfile.close()
 
-    def toJSONString(self):
+    def toJSON(self, filename):
         """
-        Returns XBRL as a JSON string
+        Exports XBRL as JSON to the given filename.
         """
+        self.export([JSONWriter(filename)])
+
+    def _jsonHeader(self):
         masterJsonObj = {
             "documentType": "http://www.xbrl.org/WGWD/YYYY-MM-DD/xbrl-json",
             "prefixes": self.namespaces,
@@ -431,9 +1089,12 @@ class AbstractXBRLInstance(object):
             "type": "schema",
             "href": self.taxonomy
         })
+        return masterJsonObj
 
-        facts = self.get_facts()
-
-        for fact in facts:
-            masterJsonObj["facts"].append( fact.toJSON() )
-        return json.dumps(masterJsonObj)
+    def toJSONString(self):
+        """
+        Returns XBRL as a JSON string
+        """
+        buf = StringIO.StringIO()
+        self.export([JSONWriter(buf)])
+        return buf.getvalue()